@@ -0,0 +1,239 @@
+""" Замеры скорости парсинга и скачивания на сохранённых страницах
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --pages 2000 --latency 0.05 --error-rate 0.01
+    python benchmarks/bench.py --skip-crawl
+    python benchmarks/bench.py --skip-parse --skip-crawl   # только проверка совпадения парсеров
+
+Модули проекта импортируются с тестовым окружением: SQLite в памяти
+и временные каталоги для страниц, поэтому настоящая БД и данные не
+затрагиваются.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, 'fixtures')
+
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+
+def setup_environment(work_dir):
+    for name in ('seafarers', 'ships', 'ship_pages'):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    os.environ.update({
+        'DATABASE_URL': 'sqlite:///:memory:',
+        'SENTRY_TOKEN': '',
+        'SEAFARER_DATA_DIR': os.path.join(work_dir, 'seafarers'),
+        'SHIP_DATA_DIR': os.path.join(work_dir, 'ships'),
+        'SHIP_PAGE_DATA_DIR': os.path.join(work_dir, 'ship_pages'),
+    })
+    os.chdir(work_dir)
+
+
+def read_fixture(name, mode='r'):
+    encoding = 'utf-8' if mode == 'r' else None
+    with open(os.path.join(FIXTURES_DIR, name), mode, encoding=encoding) as file:
+        return file.read()
+
+
+def report(name, count, elapsed, unit='pages'):
+    rate = count / elapsed if elapsed else float('inf')
+    print(f'{name:<48} {count:>7} {unit:<9} {elapsed:8.3f} s {rate:10.1f} {unit}/s')
+
+
+def measure(name, fn, iterations, unit='pages'):
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    report(name, iterations, time.perf_counter() - started, unit)
+
+
+def seafarer_variants(html):
+    """ Сохранённая анкета и её варианты с пограничными случаями """
+    service_records = html[html.index('<div class="cv-part"><h3>Service records'):html.index('<div id="footer">')]
+    return {
+        'fixture': html,
+        'no personal-cv': html.replace('id="personal-cv"', 'id="other"'),
+        'no passport': html.replace('<h3>Passport</h3>', '<h3>Documents</h3>'),
+        'no personal data': html.replace('<h3>Personal data</h3>', '<h3>About</h3>'),
+        'no service records': html.replace(service_records, ''),
+        'comment inside h2': html.replace('<h2> Ivan Petrov </h2>', '<h2> Ivan <!-- middle name --> Petrov </h2>'),
+        'only comment in h2': html.replace('<h2> Ivan Petrov </h2>', '<h2><!-- Ivan Petrov --></h2>'),
+        'linked vessel with spaces': html.replace('<td><a href="http://maritime-connector.com/ship/vessel-1-9300001/">VESSEL 1</a></td>',
+                                                  '<td> <a href="http://maritime-connector.com/ship/vessel-1-9300001/">VESSEL 1</a> </td>'),
+        'empty vessel cell': html.replace('<td><a href="http://maritime-connector.com/ship/vessel-3-9300003/">VESSEL 3</a></td>', '<td></td>'),
+        'comment in section header': html.replace('<h3>Passport</h3>', '<h3>Pass<!-- x -->port</h3>'),
+    }
+
+
+def ship_variants(html):
+    """ Сохранённая страница корабля и её варианты с пограничными случаями """
+    return {
+        'fixture': html,
+        'no ship info': html.replace('<h3>Ship info - VESSEL 1</h3>', '<h3>Details</h3>'),
+        'linked owner': html.replace('<td>Blue Sea Navigation</td>', '<td><a href="/company/1">Blue Sea Navigation</a></td>'),
+        'empty owner': html.replace('<td>Blue Sea Navigation</td>', '<td></td>'),
+        'comment inside value': html.replace('<td>Blue Sea Navigation</td>', '<td>Blue Sea <!-- x --> Navigation</td>'),
+        'comment in section header': html.replace('<h3>Ship info - VESSEL 1</h3>', '<h3>Ship <!-- x -->info - VESSEL 1</h3>'),
+    }
+
+
+def merged_docx(path):
+    """ Документ с вертикально объединёнными ячейками первого столбца """
+    from docx import Document
+
+    doc = Document()
+    # адрес объединён на три строки
+    table = doc.add_table(rows=5, cols=2)
+    table.rows[0].cells[0].paragraphs[0].add_run('ACME').bold = True
+    table.rows[1].cells[0].text = 'Addr line'
+    table.rows[1].cells[0].merge(table.rows[3].cells[0])
+    table.rows[4].cells[0].text = 'info@acme.com'
+    # жирное последнее поле компании объединено со следующей строкой
+    table = doc.add_table(rows=7, cols=1)
+    table.rows[0].cells[0].paragraphs[0].add_run('Blue Sea').bold = True
+    table.rows[1].cells[0].text = 'Port street 1'
+    table.rows[2].cells[0].paragraphs[0].add_run('Shipowner, bulk').bold = True
+    table.rows[2].cells[0].merge(table.rows[3].cells[0])
+    table.rows[4].cells[0].text = 'Harbour road 2'
+    table.rows[5].cells[0].paragraphs[0].add_run('Red Sea').bold = True
+    table.rows[6].cells[0].text = 'Quay 3'
+    doc.save(path)
+
+
+def check_parity():
+    """ Быстрые парсеры на lxml должны давать тот же результат, что и BeautifulSoup,
+    потоковое чтение docx - тот же, что и python-docx """
+    from bs4 import BeautifulSoup
+    import maritime_seafarers
+    import maritime_ships
+    import seafarersmatter_dot_com
+    import maritime_companies
+
+    cases = []
+    for name, html in seafarer_variants(read_fixture('seafarer.html')).items():
+        cases.append((f'maritime_seafarers.parse_html: {name}',
+                      maritime_seafarers.parse_html(html), maritime_seafarers.parse_html_soup(html)))
+    for name, html in ship_variants(read_fixture('ship.html')).items():
+        cases.append((f'maritime_ships.parse_info_html: {name}',
+                      maritime_ships.parse_info_html(html), maritime_ships.parse_info(BeautifulSoup(html, 'lxml'))))
+    participants = read_fixture('participants.html')
+    cases.append(('seafarersmatter_dot_com.parse_page: fixture',
+                  seafarersmatter_dot_com.parse_page(participants), seafarersmatter_dot_com.parse_page_soup(participants)))
+
+    documents = {'fixture': os.path.join(FIXTURES_DIR, 'shipowners.docx'), 'vertical merge': 'merged.docx'}
+    merged_docx(documents['vertical merge'])
+    for name, filename in documents.items():
+        cases.append((f'maritime_companies.iter_docx_rows: {name}',
+                      list(maritime_companies.parse_tables(maritime_companies.iter_docx_rows(filename))),
+                      list(maritime_companies.parse_tables(maritime_companies.document_rows(filename)))))
+
+    failed = [name for name, fast, soup in cases if fast != soup]
+    if failed:
+        raise AssertionError('Fast parsers differ from reference ones: ' + ', '.join(failed))
+    print(f'Parity: {len(cases)} cases match reference parsers')
+
+
+def bench_parse(iterations):
+    from bs4 import BeautifulSoup
+    import maritime_seafarers
+    import maritime_ships
+    import maritime_connector_dot_com
+    import seafarersmatter_dot_com
+    import maritime_companies
+    from docx import Document
+
+    seafarer = read_fixture('seafarer.html')
+    ship = read_fixture('ship.html')
+    listing = read_fixture('listing.html')
+    participants = read_fixture('participants.html')
+
+    print('Parsing')
+    measure('maritime_seafarers.parse_html', lambda: maritime_seafarers.parse_html(seafarer), iterations)
+    measure('maritime_seafarers.parse_html_soup', lambda: maritime_seafarers.parse_html_soup(seafarer), iterations)
+    measure('maritime_ships.parse_info_html', lambda: maritime_ships.parse_info_html(ship), iterations)
+    measure('maritime_ships.parse_info (with BeautifulSoup)',
+            lambda: maritime_ships.parse_info(BeautifulSoup(ship, 'lxml')), iterations)
+    measure('maritime_connector_dot_com.parse_listing',
+            lambda: maritime_connector_dot_com.parse_listing(listing), iterations)
+    measure('maritime_connector_dot_com.parse_profile',
+            lambda: maritime_connector_dot_com.parse_profile(seafarer), iterations)
+    measure('seafarersmatter_dot_com.parse_page',
+            lambda: seafarersmatter_dot_com.parse_page(participants), iterations)
+    measure('seafarersmatter_dot_com.parse_page_soup',
+            lambda: seafarersmatter_dot_com.parse_page_soup(participants), iterations)
+
+    doc = Document(os.path.join(FIXTURES_DIR, 'shipowners.docx'))
+    rows = [row for table in doc.tables for row in table.rows]
+    companies = 0
+    started = time.perf_counter()
+    for _ in range(max(1, iterations // 100)):
+        companies += sum(1 for _ in maritime_companies.parse_tables(iter(rows)))
+    report('maritime_companies.parse_table', companies, time.perf_counter() - started, 'companies')
+
+
+async def bench_crawl(pages, latency, error_rate):
+    import server
+    import maritime_seafarers
+    import maritime_ships
+    from page_store import DirectoryStore
+
+    app = server.make_app(latency, error_rate)
+    runner, base_url = await server.start(app)
+    stats = app['stats']
+    print(f'Crawling {pages} pages, latency {latency} s, error rate {error_rate}')
+    try:
+        store_dir = tempfile.mkdtemp(prefix='seafarers-', dir='.')
+        started = time.perf_counter()
+        await maritime_seafarers.download_by_ids(
+            base_url + '/seafarer/a/{0}', DirectoryStore(store_dir, '{}.html'), range(pages), 'bench'
+        )
+        report('maritime_seafarers.download_by_ids', pages, time.perf_counter() - started)
+        print(f'{"":<48} requests {stats["requests"]}, 503 responses {stats["errors"]}')
+
+        stats.update(requests=0, errors=0)
+
+        async def producer(q):
+            for number in range(pages):
+                await q.put(f'{base_url}/ship/vessel-{number}')
+
+        started = time.perf_counter()
+        await maritime_ships.download(producer)
+        report('maritime_ships producer/consumer', pages, time.perf_counter() - started)
+        print(f'{"":<48} requests {stats["requests"]}, 503 responses {stats["errors"]}')
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры скорости парсинга и скачивания')
+    parser.add_argument('--iterations', type=int, default=500, help='число разборов каждой страницы')
+    parser.add_argument('--pages', type=int, default=500, help='число страниц для скачивания')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа сервера в секундах')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--skip-parity', action='store_true')
+    parser.add_argument('--skip-parse', action='store_true')
+    parser.add_argument('--skip-crawl', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='formax-bench-') as work_dir:
+        setup_environment(work_dir)
+        if not args.skip_parity:
+            check_parity()
+        if not args.skip_parse:
+            bench_parse(args.iterations)
+        if not args.skip_crawl:
+            asyncio.run(bench_crawl(args.pages, args.latency, args.error_rate))
+        os.chdir(ROOT_DIR)
+
+
+if __name__ == '__main__':
+    main()
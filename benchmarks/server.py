@@ -0,0 +1,74 @@
+""" Локальная замена сайтов для замеров скорости скачивания
+
+Отдаёт сохранённые страницы из fixtures с настраиваемой задержкой
+и долей ответов 503.
+
+    python benchmarks/server.py --port 8080 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import os
+import random
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as file:
+        return file.read()
+
+
+def make_app(latency=0.0, error_rate=0.0):
+    """ Приложение aiohttp: /seafarer/a/{id}, /ship/{name}, /seafarers/ и /the-letter/ """
+    pages = {
+        'seafarer': read_fixture('seafarer.html'),
+        'ship': read_fixture('ship.html'),
+        'listing': read_fixture('listing.html'),
+        'participants': read_fixture('participants.html'),
+    }
+    stats = {'requests': 0, 'errors': 0}
+
+    def handler(name):
+        async def handle(request):
+            stats['requests'] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            if error_rate and random.random() < error_rate:
+                stats['errors'] += 1
+                return web.Response(status=503)
+            return web.Response(body=pages[name], content_type='text/html', charset='utf-8')
+        return handle
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_get('/seafarer/a/{id}', handler('seafarer'))
+    app.router.add_get('/ship/{name}', handler('ship'))
+    app.router.add_get('/seafarers/', handler('listing'))
+    app.router.add_get('/the-letter/', handler('participants'))
+    return app
+
+
+async def start(app, host='127.0.0.1', port=0):
+    """ Запуск сервера в текущем event loop, возвращает runner и адрес """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://{host}:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный сервер с сохранёнными страницами')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа в секундах')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.error_rate), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+""" Точка входа для всех стадий скраперов
+
+    python cli.py seafarers download [--start 1] [--stop 163552] [--refresh | --redrive]
+    python cli.py seafarers load [--batch-size 500]
+    python cli.py seafarers pipeline [--start 1] [--stop 163552] [--fetch-workers 20] [--parse-workers 4]
+    python cli.py seafarers migrate
+    python cli.py ships download [--refresh | --redrive]
+    python cli.py ships load [--batch-size 1000]
+    python cli.py ships migrate
+    python cli.py ships run [--refresh]
+    python cli.py ships pipeline [--fetch-workers 20] [--parse-workers 4] [--batch-size 1000]
+    python cli.py companies import [shipowners_and_shipmanagers.docx] [--batch-size 500] [--no-stream]
+    python cli.py connector crawl
+    python cli.py connector export
+    python cli.py seafarersmatter crawl [--concurrency 8]
+    python cli.py seafarersmatter export
+    python cli.py pages migrate SOURCE TARGET [--format '{}.html']
+
+Модули стадий импортируются только при запуске соответствующей команды,
+там же инициализируется Sentry.
+"""
+import argparse
+import asyncio
+
+from environs import Env
+
+import metrics
+import runtime
+
+env = Env()
+env.read_env('dev.env')
+
+
+def seafarers_download(args):
+    import maritime_seafarers
+
+    ids = range(args.start, (args.stop or maritime_seafarers.TOTAL_PAGE_COUNT) + 1)
+    if args.refresh:
+        coro = maritime_seafarers.refresh_seafarers(maritime_seafarers.URL_FORMAT, maritime_seafarers.pages, ids)
+    elif args.redrive:
+        coro = maritime_seafarers.redrive_failures(maritime_seafarers.URL_FORMAT, maritime_seafarers.pages)
+    else:
+        coro = maritime_seafarers.download_by_ids(
+            maritime_seafarers.URL_FORMAT, maritime_seafarers.pages, ids, 'Download maritimes'
+        )
+    asyncio.run(coro)
+
+
+def seafarers_load(args):
+    import maritime_seafarers
+
+    maritime_seafarers.main(batch_size=args.batch_size or maritime_seafarers.BATCH_SIZE)
+
+
+def seafarers_pipeline(args):
+    import maritime_seafarers
+
+    ids = range(args.start, (args.stop or maritime_seafarers.TOTAL_PAGE_COUNT) + 1)
+    asyncio.run(maritime_seafarers.run_pipeline(
+        ids,
+        fetch_workers=args.fetch_workers or maritime_seafarers.LIMIT,
+        parse_workers=maritime_seafarers.PARSE_WORKERS if args.parse_workers is None else args.parse_workers,
+        batch_size=args.batch_size or maritime_seafarers.BATCH_SIZE,
+        queue_size=args.queue_size,
+    ))
+
+
+def seafarers_migrate(args):
+    import maritime_seafarers
+
+    maritime_seafarers.migrate_vessels()
+
+
+def ships_download(args):
+    import maritime_ships
+
+    if args.redrive:
+        asyncio.run(maritime_ships.download(maritime_ships.failures_producer))
+        maritime_ships.failures.compact()
+    else:
+        producer = maritime_ships.refresh_producer if args.refresh else maritime_ships.producer
+        asyncio.run(maritime_ships.download(producer, refresh=args.refresh))
+
+
+def ships_load(args):
+    import maritime_ships
+
+    maritime_ships.load(batch_size=args.batch_size or maritime_ships.VESSEL_BATCH_SIZE)
+
+
+def ships_migrate(args):
+    import maritime_ships
+
+    maritime_ships.add_imo_number_index()
+
+
+def ships_run(args):
+    import maritime_ships
+
+    asyncio.run(maritime_ships.main(refresh=args.refresh))
+
+
+def ships_pipeline(args):
+    import maritime_ships
+
+    asyncio.run(maritime_ships.run_pipeline(
+        fetch_workers=args.fetch_workers or maritime_ships.CONSUMER_COUNT,
+        parse_workers=maritime_ships.PARSE_WORKERS if args.parse_workers is None else args.parse_workers,
+        batch_size=args.batch_size or maritime_ships.VESSEL_BATCH_SIZE,
+        queue_size=args.queue_size,
+    ))
+
+
+def companies_import(args):
+    import maritime_companies
+
+    maritime_companies.main(args.filename, batch_size=args.batch_size or maritime_companies.BATCH_SIZE, stream=args.stream)
+
+
+def connector_crawl(args):
+    import maritime_connector_dot_com
+
+    maritime_connector_dot_com.main()
+
+
+def connector_export(args):
+    import maritime_connector_dot_com
+
+    maritime_connector_dot_com.export_json()
+
+
+def seafarersmatter_crawl(args):
+    import seafarersmatter_dot_com
+
+    seafarersmatter_dot_com.main(concurrency=args.concurrency or seafarersmatter_dot_com.CONCURRENCY)
+
+
+def seafarersmatter_export(args):
+    import seafarersmatter_dot_com
+
+    seafarersmatter_dot_com.export_json()
+
+
+def pages_migrate(args):
+    import page_store
+
+    with page_store.PackedStore(args.target) as target:
+        page_store.migrate(page_store.DirectoryStore(args.source, args.format), target)
+
+
+def add_pipeline_arguments(command):
+    command.add_argument('--fetch-workers', type=int, default=None, help='одновременных запросов')
+    command.add_argument('--parse-workers', type=int, default=None, help='процессов парсинга, 0 - по числу ядер')
+    command.add_argument('--batch-size', type=int, default=None, help='объектов в одной транзакции')
+    command.add_argument('--queue-size', type=int, default=100, help='размер очередей между стадиями')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Скраперы моряков, кораблей и компаний')
+    scrapers = parser.add_subparsers(dest='scraper', required=True)
+
+    seafarers = scrapers.add_parser('seafarers', help='моряки с maritime-connector.com').add_subparsers(dest='stage', required=True)
+    command = seafarers.add_parser('download', help='скачивание страниц моряков')
+    command.add_argument('--start', type=int, default=1, help='первый id')
+    command.add_argument('--stop', type=int, default=None, help='последний id')
+    mode = command.add_mutually_exclusive_group()
+    mode.add_argument('--refresh', action='store_true', help='условное обновление уже скачанных страниц')
+    mode.add_argument('--redrive', action='store_true', help='повторное скачивание из журнала ошибок')
+    command.set_defaults(handler=seafarers_download)
+    command = seafarers.add_parser('load', help='парсинг страниц и загрузка в БД')
+    command.add_argument('--batch-size', type=int, default=None)
+    command.set_defaults(handler=seafarers_load)
+    command = seafarers.add_parser('pipeline', help='скачивание, парсинг и загрузка одновременно')
+    command.add_argument('--start', type=int, default=1, help='первый id')
+    command.add_argument('--stop', type=int, default=None, help='последний id')
+    add_pipeline_arguments(command)
+    command.set_defaults(handler=seafarers_pipeline)
+    command = seafarers.add_parser('migrate', help='миграция таблицы vessel')
+    command.set_defaults(handler=seafarers_migrate)
+
+    ships = scrapers.add_parser('ships', help='корабли').add_subparsers(dest='stage', required=True)
+    command = ships.add_parser('download', help='скачивание страниц кораблей')
+    mode = command.add_mutually_exclusive_group()
+    mode.add_argument('--refresh', action='store_true', help='условное обновление уже скачанных страниц')
+    mode.add_argument('--redrive', action='store_true', help='повторное скачивание из журнала ошибок')
+    command.set_defaults(handler=ships_download)
+    command = ships.add_parser('load', help='парсинг страниц и загрузка в БД')
+    command.add_argument('--batch-size', type=int, default=None)
+    command.set_defaults(handler=ships_load)
+    command = ships.add_parser('migrate', help='уникальный индекс vessel.imo_number')
+    command.set_defaults(handler=ships_migrate)
+    command = ships.add_parser('pipeline', help='скачивание, парсинг и загрузка одновременно')
+    add_pipeline_arguments(command)
+    command.set_defaults(handler=ships_pipeline)
+    command = ships.add_parser('run', help='скачивание и загрузка')
+    command.add_argument('--refresh', action='store_true', help='загрузить только изменившиеся страницы')
+    command.set_defaults(handler=ships_run)
+
+    companies = scrapers.add_parser('companies', help='судовладельцы из docx').add_subparsers(dest='stage', required=True)
+    command = companies.add_parser('import', help='импорт компаний в БД')
+    command.add_argument('filename', nargs='?', default='shipowners_and_shipmanagers.docx')
+    command.add_argument('--batch-size', type=int, default=None)
+    command.add_argument('--no-stream', dest='stream', action='store_false', help='читать документ через python-docx')
+    command.set_defaults(handler=companies_import)
+
+    connector = scrapers.add_parser('connector', help='профили моряков с maritime-connector.com').add_subparsers(dest='stage', required=True)
+    command = connector.add_parser('crawl', help='обход списка моряков с продолжением с места остановки')
+    command.set_defaults(handler=connector_crawl)
+    command = connector.add_parser('export', help='выгрузка seafarers.jsonl в seafarers.json')
+    command.set_defaults(handler=connector_export, sentry=False)
+
+    seafarersmatter = scrapers.add_parser('seafarersmatter', help='участники seafarersmatter.com').add_subparsers(dest='stage', required=True)
+    command = seafarersmatter.add_parser('crawl', help='обход страниц участников')
+    command.add_argument('--concurrency', type=int, default=None, help='одновременных запросов')
+    command.set_defaults(handler=seafarersmatter_crawl, aiohttp=False)
+    command = seafarersmatter.add_parser('export', help='выгрузка users.jsonl в users.json')
+    command.set_defaults(handler=seafarersmatter_export, sentry=False)
+
+    page_stores = scrapers.add_parser('pages', help='хранилища страниц').add_subparsers(dest='stage', required=True)
+    command = page_stores.add_parser('migrate', help='перенос страниц из каталога в PackedStore')
+    command.add_argument('source', help='каталог с файлами страниц')
+    command.add_argument('target', help='каталог PackedStore')
+    command.add_argument('--format', default='{}', help='шаблон имени файла, например "{}.html"')
+    command.set_defaults(handler=pages_migrate, sentry=False)
+
+    parser.set_defaults(sentry=True, aiohttp=True)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.sentry:
+        runtime.init_sentry(aiohttp=args.aiohttp)
+    metrics.start_reporting(env('METRICS_FILE', None))
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
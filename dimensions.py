@@ -0,0 +1,109 @@
+""" Кэш id справочных таблиц для пакетной загрузки
+
+Справочник (тип судна, ранг, компания и т.п.) читается из БД один раз,
+а новые значения вставляются пачками без id, после чего их id
+считываются из БД.
+"""
+
+
+class PendingId:
+    """ id нового значения справочника, известный только после flush()
+
+    Подставляется в строки вместо id; peewee приводит его к int при
+    вставке, поэтому строки нужно записывать после flush() кэша.
+    """
+    __slots__ = ('key', 'id')
+
+    def __init__(self, key):
+        self.key = key
+        self.id = None
+
+    def __int__(self):
+        if self.id is None:
+            raise ValueError(f'id for {self.key!r} is not flushed yet')
+        return self.id
+
+    def __repr__(self):
+        return f'PendingId({self.key!r}, {self.id!r})'
+
+
+class DimensionCache:
+    """ Кэш справочной таблицы: значение поля -> id
+
+    Загружает таблицу в память один раз. Для новых значений get_id()
+    возвращает PendingId; flush() вставляет их пачками без id
+    (автоинкремент БД) и читает назначенные id обратно, поэтому
+    одновременная запись в таблицу другими процессами не приводит к
+    конфликтам первичного ключа.
+    """
+    def __init__(self, model, fields=('name',), batch_size=1000):
+        self.model = model
+        self.fields = fields
+        self.batch_size = batch_size
+        self.ids = {}
+        self.pending = {}
+        self.load()
+
+    def load(self):
+        columns = [getattr(self.model, field) for field in self.fields]
+        for row in self.model.select(self.model.id, *columns).tuples().iterator():
+            for field, value in zip(self.fields, row[1:]):
+                if value:
+                    self.ids.setdefault((field, value), row[0])
+
+    def get_id(self, **kwargs):
+        """ Аналог get_or_create, но без обращения к БД: id или PendingId """
+        kwargs = {k: v for k, v in kwargs.items() if v}
+        if not kwargs: return None
+        (field, value), = kwargs.items()
+        key = (field, value)
+        if key not in self.ids:
+            self.ids[key] = self.pending[key] = PendingId(key)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+        return self.ids[key]
+
+    def flush(self):
+        """ Запись накопленных новых значений в БД и получение их id
+
+        Значения, уже добавленные в таблицу другими процессами после
+        load(), не вставляются повторно, а берутся из неё.
+        """
+        if not self.pending: return
+        values = {}
+        for field, value in self.pending:
+            values.setdefault(field, []).append(value)
+        with self.model._meta.database.atomic():
+            for field, field_values in values.items():
+                found = self.select_ids(field, field_values)
+                missing = [value for value in field_values if value not in found]
+                for i in range(0, len(missing), self.batch_size):
+                    rows = [{field: value} for value in missing[i:i + self.batch_size]]
+                    self.model.insert_many(rows=rows).execute()
+                found.update(self.select_ids(field, missing))
+                for value in field_values:
+                    self.resolve((field, value), found[value])
+        self.pending = {}
+
+    def select_ids(self, field, values):
+        """ Наименьший id для каждого из values, которые уже есть в таблице """
+        column = getattr(self.model, field)
+        ids = {}
+        for i in range(0, len(values), self.batch_size):
+            query = (self.model
+                .select(self.model.id, column)
+                .where(column.in_(values[i:i + self.batch_size]))
+                .order_by(self.model.id)
+                .tuples())
+            for row_id, value in query:
+                ids.setdefault(value, row_id)
+        return ids
+
+    def resolve(self, key, row_id):
+        self.pending[key].id = row_id
+        self.ids[key] = row_id
+
+
+def flush_dimension_caches(caches):
+    for cache in caches.values():
+        cache.flush()
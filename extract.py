@@ -0,0 +1,145 @@
+""" Быстрое извлечение разделов страниц напрямую через lxml
+
+Функции повторяют поведение используемых в парсерах методов BeautifulSoup
+(.string, .text, find_next), но работают с деревом lxml и позволяют собрать
+все нужные разделы страницы за один проход по документу.
+"""
+from lxml import etree
+from lxml import html as lxml_html
+
+
+_utf8_parser = lxml_html.HTMLParser(encoding='utf-8')
+
+
+def parse_document(html):
+    """ Построение дерева lxml из текста или байтов страницы в UTF-8 """
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    return lxml_html.document_fromstring(html, parser=_utf8_parser)
+
+
+def is_element(node):
+    return isinstance(node.tag, str)
+
+
+def has_class(element, class_name):
+    return class_name in (element.get('class') or '').split()
+
+
+def element_text(element):
+    """ Аналог Tag.text: все текстовые узлы поддерева без комментариев """
+    parts = []
+    _collect_text(element, parts)
+    return ''.join(parts)
+
+def _collect_text(element, parts):
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        if is_element(child):
+            _collect_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+
+
+def element_string(element):
+    """ Аналог Tag.string: единственная строка внутри элемента или None """
+    contents = []
+    if element.text:
+        contents.append(element.text)
+    for child in element:
+        contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+    if len(contents) != 1:
+        return None
+    content = contents[0]
+    if isinstance(content, str):
+        return content
+    if not is_element(content):
+        return content.text
+    return element_string(content)
+
+
+def find_first(element, tag, class_name=None):
+    """ Аналог Tag.find: первый подходящий потомок element """
+    for node in element.iterdescendants(tag):
+        if class_name is None or has_class(node, class_name):
+            return node
+    return None
+
+
+def find_next(element, tag, class_name=None):
+    """ Аналог Tag.find_next: первый подходящий элемент после начала element """
+    def matches(node):
+        return node.tag == tag and (class_name is None or has_class(node, class_name))
+
+    for node in element.iterdescendants(tag):
+        if matches(node):
+            return node
+
+    node = element
+    while node is not None:
+        for sibling in node.itersiblings():
+            for candidate in sibling.iter(tag):
+                if matches(candidate):
+                    return candidate
+        node = node.getparent()
+    return None
+
+
+def child_elements(element):
+    return [child for child in element if is_element(child)]
+
+
+class Sections:
+    """ Разделы страницы, собранные за один проход по документу
+
+    Для каждого заголовка из headers (текст -> ключ) запоминается первый
+    подходящий заголовок и первая таблица с классом table_class после начала
+    его родителя (как parent.find_next('table', ...)). С prefix=True заголовок
+    сравнивается по началу текста. Первые элементы из anchors (пары тег, id)
+    доступны в by_id.
+    """
+    def __init__(self, root, heading_tag, headers, table_class, prefix=False, anchors=()):
+        self.tables = {}
+        self.by_id = {}
+
+        headings = {}
+        tables = []
+        for position, element in enumerate(root.iter(etree.Element)):
+            if element.tag == heading_tag:
+                key = self._match(element_text(element).strip(), headers, prefix)
+                if key is not None and key not in headings:
+                    headings[key] = (position, element.getparent())
+            elif element.tag == 'table' and has_class(element, table_class):
+                tables.append((position, element))
+            if anchors:
+                element_id = element.get('id')
+                if (element.tag, element_id) in anchors and element_id not in self.by_id:
+                    self.by_id[element_id] = element
+
+        for key, (heading_position, parent) in headings.items():
+            self.tables[key] = next((
+                table for position, table in tables
+                if position > heading_position or _is_ancestor(parent, table)
+            ), None)
+
+    @staticmethod
+    def _match(text, headers, prefix):
+        if prefix:
+            for name, key in headers.items():
+                if text.startswith(name):
+                    return key
+            return None
+        return headers.get(text)
+
+    def rows(self, key):
+        """ Строки таблицы раздела или None, если раздела нет на странице """
+        if key not in self.tables:
+            return None
+        return list(self.tables[key].iter('tr'))
+
+
+def _is_ancestor(ancestor, element):
+    return any(node is ancestor for node in element.iterancestors())
@@ -0,0 +1,284 @@
+""" Общий асинхронный загрузчик страниц
+
+Один пул соединений aiohttp на весь запуск, повторы с экспоненциальной
+задержкой и случайным разбросом, учёт заголовка Retry-After и таймауты
+на каждый запрос. URL, которые так и не удалось скачать, записываются
+в журнал ошибок, по которому следующий запуск может их докачать.
+
+FetchManifest хранит ETag, Last-Modified и хэш содержимого по каждому URL,
+что позволяет обновлять уже скачанные страницы условными запросами.
+"""
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+
+import aiohttp
+
+import metrics
+
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+MISSING_STATUSES = {404, 410}
+
+
+NOT_MODIFIED = object()
+
+
+class FetchError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class FailureJournal:
+    """ Журнал неудачных загрузок в формате JSONL
+
+    Каждая строка - {"url": ..., "error": ..., ...} или {"url": ..., "resolved": true}.
+    entries() возвращает последнюю ошибку по каждому URL, который с тех пор
+    не был успешно скачан.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.failed = {entry['url'] for entry in self.entries()}
+
+    def entries(self):
+        if not os.path.isfile(self.path):
+            return []
+        entries = {}
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('resolved'):
+                    entries.pop(entry['url'], None)
+                else:
+                    entries[entry['url']] = entry
+        return list(entries.values())
+
+    def _append(self, entry):
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def record(self, url, error, status=None, **extra):
+        self.failed.add(url)
+        self._append({'url': url, 'error': error, 'status': status, 'time': time.time(), **extra})
+
+    def resolve(self, url):
+        if url in self.failed:
+            self.failed.discard(url)
+            self._append({'url': url, 'resolved': True})
+
+    def compact(self):
+        """ Перезапись журнала только с актуальными ошибками """
+        entries = self.entries()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for entry in entries:
+                file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+class FetchManifest:
+    """ Сведения о последнем скачивании каждого URL в SQLite """
+    def __init__(self, path, commit_every=500):
+        self.path = str(path)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fetch_manifest ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+            'content_hash TEXT, fetched_at REAL, changed_at REAL)'
+        )
+        self.connection.commit()
+
+    def get(self, url):
+        row = self.connection.execute(
+            'SELECT etag, last_modified, content_hash, fetched_at, changed_at '
+            'FROM fetch_manifest WHERE url = ?', (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('etag', 'last_modified', 'content_hash', 'fetched_at', 'changed_at'), row))
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url, etag=None, last_modified=None, content_hash=None, changed=True):
+        """ Запись результата скачивания; при changed=False обновляется только время """
+        now = time.time()
+        if changed:
+            self.connection.execute(
+                'INSERT INTO fetch_manifest (url, etag, last_modified, content_hash, fetched_at, changed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET '
+                'etag = excluded.etag, last_modified = excluded.last_modified, '
+                'content_hash = excluded.content_hash, fetched_at = excluded.fetched_at, '
+                'changed_at = excluded.changed_at',
+                (url, etag, last_modified, content_hash, now, now)
+            )
+        else:
+            self.connection.execute(
+                'UPDATE fetch_manifest SET fetched_at = ?, '
+                'etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE url = ?',
+                (now, etag, last_modified, url)
+            )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def parse_retry_after(value):
+    """ Значение Retry-After в секундах: число или HTTP-дата """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class Fetcher:
+    """ Загрузчик страниц с повторами
+
+    Использовать как асинхронный контекстный менеджер:
+
+        async with Fetcher(journal=FailureJournal('failures.jsonl')) as fetcher:
+            data = await fetcher.fetch(url)
+
+    fetch() возвращает тело ответа в байтах или None, если страницы нет (404)
+    или её не удалось скачать за retries попыток. Если передан manifest,
+    каждое успешное скачивание записывается в него, а refresh() выполняет
+    условный запрос и возвращает тело только при изменении содержимого.
+    """
+    def __init__(self, headers=None, limit=100, limit_per_host=0, timeout=30,
+                 retries=5, backoff=1.0, max_backoff=60.0, journal=None, manifest=None, name='fetch'):
+        self.name = name
+        self.headers = headers
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.journal = journal
+        self.manifest = manifest
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        self.session = None
+        if self.manifest is not None:
+            self.manifest.commit()
+
+    def delay(self, attempt, retry_after=None):
+        """ Задержка перед следующей попыткой: full jitter, но не меньше Retry-After """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def request(self, url, headers=None):
+        """ Один запрос: тело ответа, None для 404 или NOT_MODIFIED для 304 """
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                status = response.status
+                if response.status in MISSING_STATUSES:
+                    return None
+                if response.status == 304:
+                    self.remember(url, response.headers, None)
+                    return NOT_MODIFIED
+                if response.status >= 400:
+                    raise FetchError(
+                        f'{response.status} {response.reason}',
+                        status=response.status,
+                        retry_after=parse_retry_after(response.headers.get('Retry-After')),
+                    )
+                data = await response.read()
+                metrics.inc('fetch_bytes_total', len(data), source=self.name)
+                self.remember(url, response.headers, data)
+                return data
+        finally:
+            metrics.observe('fetch_seconds', time.perf_counter() - started, source=self.name, status=status)
+
+    def remember(self, url, headers, data):
+        """ Запись ответа в manifest; data=None означает 304 """
+        if self.manifest is None:
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if data is None:
+            self.manifest.update(url, etag, last_modified, changed=False)
+        else:
+            self.manifest.update(url, etag, last_modified, content_hash(data))
+
+    async def refresh(self, url, **extra):
+        """ Условное скачивание url: тело ответа, если содержимое изменилось, иначе None """
+        entry = self.manifest.get(url)
+        data = await self.fetch(url, headers=self.manifest.conditional_headers(entry), **extra)
+        if data is None or data is NOT_MODIFIED:
+            return None
+        if entry is not None and entry['content_hash'] == content_hash(data):
+            return None
+        return data
+
+    async def fetch(self, url, headers=None, **extra):
+        """ Скачивание url; extra сохраняется в журнал вместе с ошибкой """
+        error = None
+        for attempt in range(self.retries):
+            try:
+                data = await self.request(url, headers)
+                if self.journal is not None:
+                    self.journal.resolve(url)
+                return data
+            except FetchError as e:
+                error = e
+                if e.status not in RETRY_STATUSES:
+                    break
+                retry_after = e.retry_after
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                retry_after = None
+            if attempt + 1 < self.retries:
+                await asyncio.sleep(self.delay(attempt, retry_after))
+
+        import sentry_sdk
+        sentry_sdk.capture_exception(error)
+        if self.journal is not None:
+            self.journal.record(url, repr(error), status=getattr(error, 'status', None), **extra)
+        return None
@@ -0,0 +1,93 @@
+""" Очередь обхода (frontier) в SQLite
+
+Каждый найденный URL хранится один раз со статусом, числом попыток и
+временем обнаружения и последнего изменения. Страницы списков, из
+которых извлекались URL, запоминаются вместе со временем изменения
+файла, поэтому каждая разбирается только один раз.
+
+    frontier = Frontier('ship_frontier.sqlite3')
+    if not frontier.listing_parsed(name, mtime):
+        frontier.add(urls, listing=name, mtime=mtime)
+    for batch in frontier.batches():
+        ...
+        frontier.mark(url, FETCHED)
+"""
+import sqlite3
+import time
+
+PENDING = 'pending'
+FETCHED = 'fetched'
+FAILED = 'failed'
+EMPTY = 'empty'
+
+
+class Frontier:
+    def __init__(self, path, commit_every=500):
+        self.path = str(path)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(
+            'CREATE TABLE IF NOT EXISTS frontier ('
+            'url TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+            'discovered_at REAL, updated_at REAL);'
+            'CREATE INDEX IF NOT EXISTS frontier_status ON frontier (status);'
+            'CREATE TABLE IF NOT EXISTS listing (name TEXT PRIMARY KEY, mtime REAL, parsed_at REAL);'
+        )
+        self.connection.commit()
+
+    def listing_parsed(self, name, mtime=None):
+        """ Разбиралась ли страница списка (с тем же временем изменения) """
+        row = self.connection.execute('SELECT mtime FROM listing WHERE name = ?', (name,)).fetchone()
+        return row is not None and (mtime is None or row[0] == mtime)
+
+    def add(self, urls, listing=None, mtime=None):
+        """ Добавление новых URL со статусом pending; уже известные не меняются """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO frontier (url, status, discovered_at, updated_at) VALUES (?, ?, ?, ?)',
+                ((url, PENDING, now, now) for url in urls)
+            )
+            if listing is not None:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO listing (name, mtime, parsed_at) VALUES (?, ?, ?)',
+                    (listing, mtime, now)
+                )
+        self.uncommitted = 0
+
+    def batches(self, statuses=(PENDING,), batch_size=1000):
+        """ URL с заданными статусами пачками в порядке обнаружения """
+        placeholders = ', '.join('?' * len(statuses))
+        last_rowid = 0
+        while True:
+            rows = self.connection.execute(
+                f'SELECT rowid, url FROM frontier WHERE status IN ({placeholders}) AND rowid > ? '
+                f'ORDER BY rowid LIMIT ?',
+                (*statuses, last_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [url for _, url in rows]
+
+    def mark(self, url, status, attempt=True):
+        """ Новый статус URL; attempt=False - без запроса, например страница уже была скачана """
+        self.connection.execute(
+            'UPDATE frontier SET status = ?, attempts = attempts + ?, updated_at = ? WHERE url = ?',
+            (status, int(attempt), time.time(), url)
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM frontier GROUP BY status'))
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
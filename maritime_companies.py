@@ -1,7 +1,7 @@
 import itertools
 
 from docx import Document
-from bs4 import BeautifulSoup
+from lxml import etree
 import peewee
 from peewee import Model, CharField, ForeignKeyField
 from environs import Env
@@ -10,22 +10,78 @@ from tqdm import tqdm
 import re
 import sys
 import os
+import zipfile
+
+import metrics
+from runtime import LazyDatabase
 
 env = Env()
 env.read_env('dev.env')
 
-doc = Document('shipowners_and_shipmanagers.docx')
+BATCH_SIZE = env.int('COMPANY_BATCH_SIZE', 500)
+
+W_NAMESPACE = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+ROW_TAG = f'{{{W_NAMESPACE}}}tr'
+
+# XPath по уже разобранному python-docx дереву, без сериализации в строку
+_first_cell = etree.XPath('./w:tc[1]', namespaces={'w': W_NAMESPACE})
+_cell_paragraphs = etree.XPath('./w:p', namespaces={'w': W_NAMESPACE})
+_merge_continue = etree.XPath(
+    './w:tcPr/w:vMerge[not(@w:val) or @w:val="continue"]', namespaces={'w': W_NAMESPACE}
+)
+_paragraph_words = etree.XPath('.//w:t/text()', namespaces={'w': W_NAMESPACE})
+_bold_fonts = etree.XPath('.//w:b', namespaces={'w': W_NAMESPACE})
+
+
+class StreamedRow:
+    """ Строка из iter_docx_rows(): элемент w:tr как у строки python-docx и
+    сохранённая первая ячейка, с которой начато вертикальное объединение """
+    __slots__ = ('_tr', 'merge_start')
+
+    def __init__(self, tr, merge_start=None):
+        self._tr = tr
+        self.merge_start = merge_start
+
+
+def _row_element(row):
+    """ Элемент w:tr строки python-docx или StreamedRow """
+    return row._tr
+
+
+def _first_cell_element(row):
+    """ Первая ячейка строки, как row.cells[0] в python-docx
+
+    Продолжение вертикального объединения (w:vMerge без val или
+    val="continue") заменяется ячейкой, с которой объединение начато:
+    сохранённой в StreamedRow или найденной в предыдущих строках.
+    """
+    tr = _row_element(row)
+    cells = _first_cell(tr)
+    if cells and _merge_continue(cells[0]) and getattr(row, 'merge_start', None) is not None:
+        return row.merge_start
+    while cells and _merge_continue(cells[0]):
+        tr = tr.getprevious()
+        while tr is not None and tr.tag != ROW_TAG:
+            tr = tr.getprevious()
+        if tr is None:
+            break
+        cells = _first_cell(tr)
+    return cells[0] if cells else None
+
 
 def _get_text(row):
     data = []
-    for paragraph in row.cells[0].paragraphs:
-        doc = BeautifulSoup(paragraph._p.xml, 'lxml')            
-        words = doc.find_all('w:t')           
-        words = filter(lambda item: item.string.strip()!='', words)
-        data.append(' '.join([word.string.strip() for word in words if word.string.strip()]))
+    cell = _first_cell_element(row)
+    for paragraph in (_cell_paragraphs(cell) if cell is not None else ()):
+        words = (word.strip() for word in _paragraph_words(paragraph))
+        data.append(' '.join([word for word in words if word]))
     return ''.join(data)
 
 
+def _is_bold(row):
+    return bool(_bold_fonts(_row_element(row)))
+
+
 def _get_phone(text):
     for i in text:
         if i not in ' -()+,.;/' and not i.isdigit():
@@ -53,9 +109,7 @@ def parse_table(row_gen):
 
     while True:
         row = next(row_gen)
-        tr = BeautifulSoup(row._tr.xml, 'lxml')            
-        bold_font = tr.find('w:b')  
-        if bold_font is None:
+        if not _is_bold(row):
             continue
 
         break
@@ -121,7 +175,7 @@ def parse_table(row_gen):
 
     return obj
 
-db = connect(env('DATABASE_URL'))
+db = LazyDatabase(lambda: connect(env('DATABASE_URL')))
 
 class BaseModel(Model):
     class Meta:
@@ -160,42 +214,158 @@ def parse_tables(row_gen):
         except StopIteration:
             return
 
-row_gen = (
-    row
-    for table in doc.tables
-    for row in table.rows
-)
-
-# for tables in tqdm(zip(doc.tables, doc.tables[1:] + [None]), total=len(doc.tables)):
-
-i = 0
-for obj in tqdm(parse_tables(row_gen)):
-    i += 1
-    
-    company = DocxCompany.create(
-        name=obj['name'],
-        address=obj['address'] if obj.get('address') else None,
-        description=obj['description'] if obj.get('description') else None,
+def document_rows(filename):
+    """ Строки всех таблиц документа через python-docx, документ целиком в памяти """
+    doc = Document(filename)
+    return (
+        row
+        for table in doc.tables
+        for row in table.rows
     )
 
-    if 'phone' in obj.keys():
-        if isinstance(obj['phone'], list):
-            obj_list = [{'company_id': company.id, 'number': number} for number in obj['phone']]
-            DocxPhone.insert_many(rows=obj_list).execute()
-        else:
-            DocxPhone.create(company_id=company.id, number=obj['phone'])
-    
-    if 'email' in obj.keys():
-        if isinstance(obj['email'], list):
-            obj_list = [{'company_id': company.id, 'address': address} for address in obj['email']]
-            DocxEmail.insert_many(rows=obj_list).execute()
-        else:
-            DocxEmail.create(company_id=company.id, address=obj['email'])
-
-    if 'site' in obj.keys():    
-        if isinstance(obj['site'], list):
-            obj_list = [{'company_id': company.id, 'url': address} for address in obj['site']]
-            DocxSite.insert_many(rows=obj_list).execute()
-        else:
-            DocxSite.create(company_id=company.id, url=obj['site'])
 
+def iter_docx_rows(filename):
+    """ Потоковое чтение строк таблиц из word/document.xml
+
+    Возвращает строки таблиц верхнего уровня (как doc.tables в
+    python-docx) по одному в виде StreamedRow. Разобранные строки и прочие элементы тела
+    документа удаляются из дерева, поэтому память не растёт с размером
+    файла. Строку можно использовать только до запроса следующей.
+
+    Первая ячейка, с которой начато вертикальное объединение, сохраняется
+    до конца таблицы и передаётся со строками-продолжениями, так как
+    предыдущих строк в дереве уже нет. Сама строка не меняется, поэтому
+    жирный шрифт проверяется, как и в python-docx, только по её ячейкам.
+    """
+    body_tag = f'{{{W_NAMESPACE}}}body'
+    table_tag = f'{{{W_NAMESPACE}}}tbl'
+    tags = (ROW_TAG, table_tag, f'{{{W_NAMESPACE}}}p', f'{{{W_NAMESPACE}}}sectPr')
+    merge_start = None
+
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open('word/document.xml') as file:
+            for _, element in etree.iterparse(file, events=('end',), tag=tags):
+                parent = element.getparent()
+                if parent is None:
+                    continue
+                if element.tag == ROW_TAG:
+                    grandparent = parent.getparent()
+                    if parent.tag != table_tag or grandparent is None or grandparent.tag != body_tag:
+                        continue
+                    cells = _first_cell(element)
+                    if cells and _merge_continue(cells[0]):
+                        yield StreamedRow(element, merge_start)
+                    else:
+                        if cells:
+                            merge_start = cells[0]
+                        yield StreamedRow(element)
+                    if merge_start is not None and merge_start.getparent() is element:
+                        element.remove(merge_start)
+                elif parent.tag != body_tag:
+                    continue
+                elif element.tag == table_tag:
+                    merge_start = None
+
+                element.clear()
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def company_row(obj):
+    """ Строка DocxCompany без id, id назначает БД """
+    return {
+        'name': obj['name'],
+        'address': obj['address'] if obj.get('address') else None,
+        'description': obj['description'] if obj.get('description') else None,
+    }
+
+
+def contact_rows(obj, company_id):
+    """ Строки телефонов, почт и сайтов компании """
+    phones = [{'company_id': company_id, 'number': number} for number in _as_list(obj.get('phone', []))]
+    emails = [{'company_id': company_id, 'address': address} for address in _as_list(obj.get('email', []))]
+    sites = [{'company_id': company_id, 'url': url} for url in _as_list(obj.get('site', []))]
+    return phones, emails, sites
+
+
+def _consecutive_auto_increment():
+    """ Получает ли многострочный INSERT в MySQL подряд идущие id
+
+    При innodb_autoinc_lock_mode 0 и 1 id одного INSERT с известным числом
+    строк идут подряд, при 2 они могут чередоваться с другими сессиями.
+    """
+    mode, = db.execute_sql('SELECT @@innodb_autoinc_lock_mode').fetchone()
+    return int(mode) in (0, 1)
+
+
+def insert_companies(rows, chunk_size=BATCH_SIZE):
+    """ Вставка компаний без id, возвращает назначенные БД id в порядке rows
+
+    SQLite и Postgres возвращают id через RETURNING, в порядке VALUES они
+    возрастают. MySQL возвращает id первой строки, остальные идут подряд,
+    если это гарантирует режим автоинкремента, иначе строки вставляются
+    по одной.
+    """
+    ids = []
+    if isinstance(db.obj, peewee.MySQLDatabase):
+        consecutive = _consecutive_auto_increment()
+        for chunk in peewee.chunked(rows, chunk_size):
+            if consecutive:
+                first_id = DocxCompany.insert_many(rows=chunk).execute()
+                ids.extend(range(first_id, first_id + len(chunk)))
+            else:
+                ids.extend(DocxCompany.insert(**row).execute() for row in chunk)
+        return ids
+
+    for chunk in peewee.chunked(rows, chunk_size):
+        query = DocxCompany.insert_many(rows=chunk).returning(DocxCompany.id).tuples()
+        ids.extend(sorted(company_id for company_id, in query.execute()))
+    return ids
+
+
+def write_batch(objs, chunk_size=BATCH_SIZE):
+    """ Запись пачки компаний в одной транзакции
+
+    Компании вставляются без id, по назначенным БД id собираются строки
+    телефонов, почт и сайтов, которые вставляются одним insert_many на
+    таблицу. Поэтому одновременно могут работать несколько импортов.
+    """
+    with metrics.timer('db_batch_seconds', source='companies'):
+        with db.atomic():
+            company_ids = insert_companies([company_row(obj) for obj in objs], chunk_size)
+            tables = {DocxPhone: [], DocxEmail: [], DocxSite: []}
+            for company_id, obj in zip(company_ids, objs):
+                phones, emails, sites = contact_rows(obj, company_id)
+                tables[DocxPhone].extend(phones)
+                tables[DocxEmail].extend(emails)
+                tables[DocxSite].extend(sites)
+
+            for model, rows in tables.items():
+                for chunk in peewee.chunked(rows, chunk_size):
+                    model.insert_many(rows=chunk).execute()
+
+    metrics.inc('db_rows_total', len(company_ids), source='companies', table=DocxCompany._meta.table_name)
+    for model, rows in tables.items():
+        metrics.inc('db_rows_total', len(rows), source='companies', table=model._meta.table_name)
+
+
+def main(filename='shipowners_and_shipmanagers.docx', batch_size=BATCH_SIZE, stream=True):
+    row_gen = iter_docx_rows(filename) if stream else document_rows(filename)
+
+    batch = []
+    for obj in tqdm(parse_tables(row_gen)):
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            write_batch(batch)
+            batch = []
+
+    if batch:
+        write_batch(batch)
+
+if __name__ == '__main__':
+    import cli
+    cli.main(['companies', *(sys.argv[1:] or ['import'])])
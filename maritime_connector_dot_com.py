@@ -1,20 +1,123 @@
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+import threading
+import queue
+import hashlib
+import tempfile
+import sqlite3
 import json
 from console_progressbar import ProgressBar
 import sys
 import time
-import shutil
 import os
 from urllib.parse import urlparse
 
+import metrics
+from runtime import Lazy
+from page_store import DirectoryManifest
+
 site = 'http://maritime-connector.com'
 
+CONCURRENCY = 16
+AVATAR_WORKERS = 8
+
+# сессию одновременно используют потоки профилей и кораблей (по CONCURRENCY)
+# и потоки аватаров, лишние соединения сверх pool_maxsize закрывались бы
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CONCURRENCY * 2 + AVATAR_WORKERS)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+
+def http_get(url, **kwargs):
+    """ session.get с замером времени ответа и объёма скачанных данных """
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = session.get(url, **kwargs)
+        status = response.status_code
+        if not kwargs.get('stream'):
+            metrics.inc('fetch_bytes_total', len(response.content), source='maritime_connector')
+        return response
+    finally:
+        metrics.observe('fetch_seconds', time.perf_counter() - started, source='maritime_connector', status=status)
+
+
+class VesselCache:
+    """ Кэш href судна -> IMO номер
+
+    Первый уровень - LRU в памяти, второй - SQLite на диске, переживающий
+    перезапуски. Одновременные запросы одного и того же href из разных
+    потоков ждут единственной загрузки страницы судна.
+    """
+    _MISSING = object()
+
+    def __init__(self, path='vessels.sqlite3', size=10000):
+        self.size = size
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS vessel_imo (href TEXT PRIMARY KEY, imo_number TEXT)')
+        self.connection.commit()
+
+    def _remember(self, href, imo_number):
+        self.memory[href] = imo_number
+        self.memory.move_to_end(href)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, href):
+        if href in self.memory:
+            self.memory.move_to_end(href)
+            return self.memory[href]
+        row = self.connection.execute('SELECT imo_number FROM vessel_imo WHERE href = ?', (href,)).fetchone()
+        if row is None:
+            return self._MISSING
+        self._remember(href, row[0])
+        return row[0]
+
+    def get(self, href, loader):
+        """ IMO номер из кэша или результат loader(href), сохранённый в кэш """
+        with self.lock:
+            imo_number = self._lookup(href)
+            if imo_number is not self._MISSING:
+                return imo_number
+            future = self.in_flight.get(href)
+            owner = future is None
+            if owner:
+                future = self.in_flight[href] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            imo_number = loader(href)
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[href]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO vessel_imo VALUES (?, ?)', (href, imo_number))
+            self.connection.commit()
+            self._remember(href, imo_number)
+            del self.in_flight[href]
+        future.set_result(imo_number)
+        return imo_number
+
+
+vessel_cache = Lazy(VesselCache)
+
 def get_total_count():
     try:
         url = f'{site}/seafarers/?page=1'
-        response = requests.get(url)
+        response = http_get(url)
         response.raise_for_status()
         page = response.content.decode('utf-8')
         page = BeautifulSoup(page, 'lxml')
@@ -25,14 +128,320 @@ def get_total_count():
     return total_count
 
 
-def get_page(page_number):
-    users = []
-    url = f'{site}/seafarers/?page={page_number}'
-    
-    response = requests.get(url)
-    response.raise_for_status()
+class AvatarDownloader:
+    """ Отдельная стадия скачивания аватаров
+
+    submit() сразу возвращает имя файла, а само скачивание выполняется
+    фоновыми потоками из очереди. Имя файла содержит хэш URL, поэтому разные
+    URL с одинаковым basename не перезаписывают друг друга. Уже скачанные
+    файлы и повторные URL пропускаются, файлы с одинаковым содержимым
+    сохраняются жёсткими ссылками на один файл. Запись идёт во временный
+    файл с атомарным переименованием.
+
+    Файл, сохранённый прежней версией под именем basename, не скачивается
+    заново, а получает жёсткую ссылку с новым именем - если в этом запуске
+    на этот basename не претендует другой URL.
+    """
+    HASHES_FILENAME = '.hashes'
+
+    def __init__(self, directory='avatars', workers=AVATAR_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.seen = set()
+        self.legacy = {}
+        self.hashes = None
+        self.files = None
+        self.lock = threading.Lock()
+        self.threads = []
+
+    @staticmethod
+    def get_filename(href):
+        basename = os.path.basename(urlparse(href).path)
+        url_hash = hashlib.md5(href.encode('utf-8')).hexdigest()[:10]
+        return f'{url_hash}-{basename}'
+
+    def submit(self, href):
+        filename = self.get_filename(href)
+        with self.lock:
+            if href in self.seen:
+                return filename
+            self.seen.add(href)
+            if not self.threads:
+                self._start()
+            if filename not in self.files and self._link_legacy(href, filename):
+                return filename
+        if filename not in self.files:
+            self.queue.put((href, filename))
+        return filename
+
+    def _link_legacy(self, href, filename):
+        """ Ссылка с нового имени на файл прежнего формата (basename из URL) """
+        basename = os.path.basename(urlparse(href).path)
+        if self.legacy.setdefault(basename, href) != href or basename not in self.files:
+            return False
+        try:
+            os.link(os.path.join(self.directory, basename), os.path.join(self.directory, filename))
+        except FileExistsError:
+            pass
+        except OSError:
+            return False
+        self.files.add(filename)
+        metrics.inc('avatar_legacy_total', source='maritime_connector')
+        return True
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = DirectoryManifest(self.directory)
+        self.hashes = self._load_hashes()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _load_hashes(self):
+        hashes = {}
+        try:
+            with open(os.path.join(self.directory, self.HASHES_FILENAME), 'r') as file:
+                for line in file:
+                    content_hash, filename = line.rstrip('\n').split(' ', 1)
+                    if filename in self.files:
+                        hashes[content_hash] = filename
+        except FileNotFoundError:
+            pass
+        return hashes
+
+    def _worker(self):
+        while True:
+            href, filename = self.queue.get()
+            try:
+                self.download(href, filename)
+            except requests.RequestException:
+                metrics.inc('avatar_errors_total', source='maritime_connector', error='request')
+            except Exception as e:
+                # ошибка записи не должна останавливать поток, иначе join() никогда не вернётся
+                metrics.inc('avatar_errors_total', source='maritime_connector', error=type(e).__name__)
+                import sentry_sdk
+                sentry_sdk.capture_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def download(self, href, filename):
+        path = os.path.join(self.directory, filename)
+        with http_get(href, stream=True) as response:
+            response.raise_for_status()
+            self._write(response, path, filename)
+
+    def _write(self, response, path, filename):
+        content_hash = hashlib.sha1()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in response.iter_content(64 * 1024):
+                    content_hash.update(chunk)
+                    file.write(chunk)
+                    metrics.inc('fetch_bytes_total', len(chunk), source='maritime_connector')
+            os.chmod(tmp_path, 0o644)
+            content_hash = content_hash.hexdigest()
+
+            with self.lock:
+                existing = self.hashes.get(content_hash)
+                if existing is not None:
+                    try:
+                        os.link(os.path.join(self.directory, existing), tmp_path + '.link')
+                    except FileNotFoundError:
+                        # файл с тем же содержимым удалён, сохраняется как новый
+                        del self.hashes[content_hash]
+                    else:
+                        os.replace(tmp_path + '.link', path)
+                        os.remove(tmp_path)
+                        self.files.add(filename)
+                        return
+                os.replace(tmp_path, path)
+                self.files.add(filename)
+                self.hashes[content_hash] = filename
+                with open(os.path.join(self.directory, self.HASHES_FILENAME), 'a') as file:
+                    file.write(f'{content_hash} {filename}\n')
+        except BaseException:
+            for leftover in (tmp_path, tmp_path + '.link'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+
+    def join(self):
+        """ Ожидание окончания всех поставленных в очередь скачиваний """
+        self.queue.join()
+
+
+avatars = AvatarDownloader()
+
+
+def get_imo_number(href):
+    ship_page_response = http_get(href)
+    ship_page_response.raise_for_status()
+
+    ship_page = ship_page_response.content.decode('utf-8')
+    ship_page = BeautifulSoup(ship_page, 'lxml')
+
+    imo_number = None
+    ship_table_rows = ship_page.find('table', {'class': 'ship-data-table'}).select('tr')
+    for ship_table_row in ship_table_rows:
+        if not isinstance(ship_table_row, Tag):
+            continue
+
+        for cell in ship_table_row.children:
+            if not isinstance(cell, Tag):
+                continue
+            if not cell.string:
+                continue
+            cell_text = cell.string.strip()
+            if cell_text == 'IMO number':
+                imo_number = cell.parent.find_next('td').string.strip()
+    return imo_number
+
 
-    page = response.content.decode('utf-8')
+def parse_profile(page):
+    """ Разбор страницы профиля моряка
+
+    У записей со ссылкой на судно imo_number равен None, его заполняет get_user().
+    """
+    page = BeautifulSoup(page, 'lxml')
+    description = page.find('div', {'class': 'description'})
+    if not description:
+        description = page.find('p', {'class': 'description'})
+
+    avatar = description.find('a', {'rel': 'prettyPhoto[profile]'})
+
+    parts = page.select('h3')
+    department = ''
+    rank = ''
+    nationality = ''
+    records = []
+
+    for part in parts:
+        if not isinstance(part, Tag):
+            continue
+        if not part.text:
+            continue
+        text = part.text.strip()
+        rows = part.parent.findNext('table', {'class': 'cv-data-table'}).select('tr')
+
+        if text == 'Personal data':
+            for row in rows:
+                for cell in row.children:
+                    if not isinstance(cell, Tag):
+                        continue
+                    if not cell.string:
+                        continue
+                    cell_text = cell.string.strip()
+                    if cell_text == 'Current department':
+                        department = cell.parent.findNext('td').string.strip()
+                    elif cell_text == 'Current rank':
+                        rank = cell.parent.findNext('td').string.strip()
+        elif text == 'Passport':
+            for row in rows:
+                offset = 0
+                for cell in row.children:
+                    if not isinstance(cell, Tag):
+                        continue
+                    if not cell.string:
+                        continue
+                    cell_text = cell.string.strip()
+                    if cell_text == 'Nationality':
+                        data_cells = cell.parent.findNext('tr').select('td')
+                        nationality = data_cells[offset].string.strip()
+                    offset += 1
+        elif text == 'Service records':
+            row_index = 0
+            for row in rows:
+                if row_index == 0:
+                    row_index += 1
+                    continue
+
+                record = {}
+                cells = row.find_all('td')
+                if (len(cells) >= 7):
+                    record['department'] = cells[0].string.strip() if cells[0].string else ''
+                    record['rank'] = cells[1].string.strip() if cells[1].string else ''
+                    record['ship_type'] = cells[2].string.strip() if cells[2].string else ''
+
+                    if cells[3].string:
+                        record['vessel_name'] = cells[3].string.strip()
+                    elif isinstance(cells[3], Tag):
+                        record['vessel_name'] = cells[3].find('a').attrs['href']
+                        record['imo_number'] = None
+
+                    record['company'] = cells[4].string.strip() if cells[4].string else ''
+                    record['from'] = cells[5].string.strip() if cells[5].string else ''
+                    record['to'] = cells[6].string.strip() if cells[6].string else ''
+
+                if row_index > 0 and bool(record):
+                    records.append(record)
+                row_index += 1
+    title = description.find('h2').string
+    title = title.strip() if title else ''
+
+    return {
+        'avatar': avatar.attrs['href'] if avatar else None,
+        'title': title,
+        'department': department,
+        'rank': rank,
+        'nationality': nationality,
+        'service_records': records,
+    }
+
+
+def get_user(href, executor):
+    """ Скачивание и разбор профиля моряка
+
+    Страницы судов скачиваются параллельно в executor, аватары -
+    в отдельной стадии avatars.
+    """
+    try:
+        response = http_get(href)
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        return {
+            'href': href,
+            'error': f'{e.response.status_code} {e.response.reason}'
+        }
+
+    with metrics.timer('parse_seconds', source='maritime_connector'):
+        profile = parse_profile(response.content.decode('utf-8'))
+    records = profile['service_records']
+
+    for record in records:
+        if 'imo_number' in record:
+            record['imo_number'] = executor.submit(vessel_cache.get, record['vessel_name'], get_imo_number)
+
+    avatar = None
+    if profile['avatar']:
+        avatar = {
+            'href': profile['avatar'],
+            'filename': avatars.submit(profile['avatar']),
+        }
+
+    for record in records:
+        if 'imo_number' in record:
+            imo_number = record['imo_number'].result()
+            if imo_number is None:
+                del record['imo_number']
+            else:
+                record['imo_number'] = imo_number
+
+    return {
+        'href': href,
+        'avatar': avatar,
+        'title': profile['title'],
+        'department': profile['department'],
+        'rank': profile['rank'],
+        'nationality': profile['nationality'],
+        'service_records': records,
+    }
+
+
+def parse_listing(page):
+    """ Ссылки на профили и общее число моряков со страницы списка """
     page = BeautifulSoup(page, 'lxml')
 
     container = page.find('ul', {'id': 'results-list'})
@@ -42,9 +451,10 @@ def get_page(page_number):
         total_count = int(page.find('p', {'class': 'result-count'}).string.lower().split(' of ')[1])
     except:
         total_count = None
-    
+
     items = container.select('li')
-    
+
+    hrefs = []
     for item in items:
         href = ''
         for cell in item.children:
@@ -52,167 +462,133 @@ def get_page(page_number):
                 continue
             if cell.name == 'a':
                 href = cell.attrs['href']
-                break        
-        try:
-            response = requests.get(href)
-            response.raise_for_status()
-        except requests.HTTPError as e:
-            users.append({
-                'href': href,
-                'error': f'{e.response.status_code} {e.response.reason}'
-            })
-            continue        
+                break
+        hrefs.append(href)
 
-        page = response.content.decode('utf-8')
-        page = BeautifulSoup(page, 'lxml')
-        description = page.find('div', {'class': 'description'})
-        if not description:
-            description = page.find('p', {'class': 'description'})
-        
-        avatar = description.find('a', {'rel': 'prettyPhoto[profile]'})
-        if avatar:
-            avatar_image = requests.get(avatar.attrs['href'], stream=True)
-
-            filename = os.path.basename(urlparse(avatar.attrs['href']).path)
-            with open(f'avatars/{filename}', 'wb') as file:
-                avatar_image.raw.decode_content = True
-                shutil.copyfileobj(avatar_image.raw, file)
-
-        parts = page.select('h3')        
-        department = ''
-        rank = ''
-        nationality = ''
-        records = []
-        
-        for part in parts:
-            if not isinstance(part, Tag):
-                continue
-            if not part.text:
-                continue
-            text = part.text.strip()
-            rows = part.parent.findNext('table', {'class': 'cv-data-table'}).select('tr')
-
-            if text == 'Personal data':
-                for row in rows:
-                    for cell in row.children:
-                        if not isinstance(cell, Tag):
-                            continue
-                        if not cell.string:
-                            continue
-                        cell_text = cell.string.strip()
-                        if cell_text == 'Current department':
-                            department = cell.parent.findNext('td').string.strip()
-                        elif cell_text == 'Current rank':
-                            rank = cell.parent.findNext('td').string.strip()
-            elif text == 'Passport':                
-                for row in rows:
-                    offset = 0
-                    for cell in row.children:
-                        if not isinstance(cell, Tag):
-                            continue
-                        if not cell.string:
-                            continue
-                        cell_text = cell.string.strip()
-                        if cell_text == 'Nationality':
-                            data_cells = cell.parent.findNext('tr').select('td')
-                            nationality = data_cells[offset].string.strip()
-                        offset += 1
-            elif text == 'Service records':
-                row_index = 0
-                for row in rows:
-                    if row_index == 0:
-                        row_index += 1
-                        continue
+    return hrefs, total_count
 
-                    record = {}                    
-                    cells = row.find_all('td')
-                    if (len(cells) >= 7):
-                        record['department'] = cells[0].string.strip() if cells[0].string else ''
-                        record['rank'] = cells[1].string.strip() if cells[1].string else ''
-                        record['ship_type'] = cells[2].string.strip() if cells[2].string else ''
-                        
-                        if cells[3].string:
-                            record['vessel_name'] = cells[3].string.strip()
-                        elif isinstance(cells[3], Tag):
-                            record['vessel_name'] = cells[3].find('a').attrs['href']
-                            ship_page_response = requests.get(record['vessel_name'])
-                            ship_page_response.raise_for_status()
-
-                            ship_page = ship_page_response.content.decode('utf-8')
-                            ship_page = BeautifulSoup(ship_page, 'lxml')
-
-                            ship_table_rows = ship_page.find('table', {'class': 'ship-data-table'}).select('tr')
-                            for ship_table_row in ship_table_rows:
-                                if not isinstance(ship_table_row, Tag):
-                                    continue
-
-                                for cell in ship_table_row.children:
-                                    if not isinstance(cell, Tag):
-                                        continue
-                                    if not cell.string:
-                                        continue
-                                    cell_text = cell.string.strip()
-                                    if cell_text == 'IMO number':
-                                        record['imo_number'] = cell.parent.find_next('td').string.strip()
-
-                        record['company'] = cells[4].string.strip() if cells[4].string else ''
-                        record['from'] = cells[5].string.strip() if cells[5].string else ''
-                        record['to'] = cells[6].string.strip() if cells[6].string else ''
-                        
-                    if row_index > 0 and bool(record):
-                        records.append(record)
-                    row_index += 1
-        title = description.find('h2').string
-        title = title.strip() if title else ''
 
-        users.append({
-            'href': href,
-            'avatar': {
-                'href': avatar.attrs['href'],
-                'filename': filename,
-            },
-            'title': title,
-            'department': department,
-            'rank': rank,
-            'nationality': nationality,
-            'service_records': records,
-        })
-    
+def get_page(page_number, concurrency=CONCURRENCY):
+    url = f'{site}/seafarers/?page={page_number}'
+
+    response = http_get(url)
+    response.raise_for_status()
+
+    hrefs, total_count = parse_listing(response.content.decode('utf-8'))
+
+    # Профили и их подзапросы выполняются в разных пулах, чтобы задачи
+    # профилей не ждали освобождения потоков, занятых ими же.
+    with ThreadPoolExecutor(concurrency) as profile_executor, ThreadPoolExecutor(concurrency) as executor:
+        users = list(profile_executor.map(lambda href: get_user(href, executor), hrefs))
+
     return users, total_count
 
 
-def main():
-    all_users = []    
+USERS_FILENAME = 'seafarers.jsonl'
+PROGRESS_FILENAME = 'seafarers.progress.json'
+EXPORT_FILENAME = 'seafarers.json'
+
 
-    completed_count = 0
-    page = 1
+def read_progress():
+    """ Состояние обхода: последняя страница, число пользователей и размер JSONL """
     try:
-        with open('seafarers.json', 'r') as file:
+        with open(PROGRESS_FILENAME, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_progress(progress):
+    tmp_filename = PROGRESS_FILENAME + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(progress, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_filename, PROGRESS_FILENAME)
+
+
+def import_legacy_checkpoint():
+    """ Перенос старого seafarers.json в JSONL, если обход начинался в старом формате """
+    try:
+        with open(EXPORT_FILENAME, 'r') as file:
             data = json.load(file)
-            page = int(data['completed_page']) + 1
-            total_count = int(data['total_count'])
-            all_users = data['data']
     except FileNotFoundError:
+        return None
+
+    with open(USERS_FILENAME, 'w') as file:
+        for user in data['data']:
+            file.write(json.dumps(user) + '\n')
+        offset = file.tell()
+
+    progress = {
+        'completed_count': len(data['data']),
+        'completed_page': int(data['completed_page']),
+        'total_count': int(data['total_count']),
+        'offset': offset,
+    }
+    write_progress(progress)
+    return progress
+
+
+def export_json(filename=EXPORT_FILENAME):
+    """ Сборка JSONL и состояния обхода в прежний формат seafarers.json """
+    progress = read_progress()
+    with open(USERS_FILENAME, 'rb') as file:
+        lines = file.read(progress['offset']).decode('utf-8').splitlines()
+    data = [json.loads(line) for line in lines if line]
+
+    with open(filename, 'w') as file:
+        json.dump({
+            'completed_count': progress['completed_count'],
+            'completed_page': progress['completed_page'],
+            'total_count': progress['total_count'],
+            'data': data,
+        }, file, indent=4)
+
+
+def main():
+    metrics.start_reporting(os.environ.get('METRICS_FILE'))
+    progress = read_progress() or import_legacy_checkpoint()
+    if progress:
+        page = progress['completed_page'] + 1
+        total_count = progress['total_count']
+        completed_count = progress['completed_count']
+        offset = progress['offset']
+    else:
+        page = 1
         total_count = get_total_count()
-    
+        completed_count = 0
+        offset = 0
+
     pb = ProgressBar(total=total_count,prefix='Here', suffix='Now', decimals=3, length=50, fill='\u25A0', zfill='-')
-    pb.print_progress_bar(len(all_users))
-    
-    while len(all_users) < total_count:
-        users, total_count = get_page(page)
-        all_users.extend(users)
-    
-        with open('seafarers.json', 'w') as file:
-            json.dump({
-                'completed_count': len(all_users),
+    pb.print_progress_bar(completed_count)
+
+    with open(USERS_FILENAME, 'a+') as users_file:
+        # Пользователи, дописанные после последней сохранённой страницы, отбрасываются
+        users_file.truncate(offset)
+        users_file.seek(offset)
+
+        while completed_count < total_count:
+            users, total_count = get_page(page)
+            for user in users:
+                users_file.write(json.dumps(user) + '\n')
+            users_file.flush()
+            completed_count += len(users)
+            total_count = total_count if total_count else page
+
+            write_progress({
+                'completed_count': completed_count,
                 'completed_page': page,
-                'total_count': total_count if total_count else page,
-                'data': all_users,
-            }, file, indent=4)
+                'total_count': total_count,
+                'offset': users_file.tell(),
+            })
+
+            pb.print_progress_bar(completed_count)
+            page += 1
+
+    avatars.join()
 
-        pb.print_progress_bar(len(all_users))        
-        page += 1
-    
 
 if __name__ == '__main__':
-    main()
+    import cli
+    cli.main(['connector', *(sys.argv[1:] or ['crawl'])])
@@ -1,27 +1,41 @@
-import aiohttp
 import asyncio
-import os
 import sys
-import sentry_sdk
-from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from tqdm import tqdm
 import peewee
 from bs4 import BeautifulSoup
 from bs4.element import Tag
-from peewee import IntegerField, CharField, ForeignKeyField
+from peewee import Model, IntegerField, CharField, DateField, ForeignKeyField
 from playhouse.db_url import connect
+from playhouse.migrate import migrate, MySQLMigrator
 from playhouse.shortcuts import model_to_dict, dict_to_model
 from environs import Env
+from parallel import parallel_map
+from runtime import Lazy, LazyDatabase
+from dimensions import DimensionCache, flush_dimension_caches
+import metrics
+import time
+import extract
 
 env = Env()
 env.read_env('dev.env')
-db = connect(env('DATABASE_URL'))
-data_dir = env.path('SEAFARER_DATA_DIR')
+db = LazyDatabase(lambda: connect(env('DATABASE_URL')))
 
-sentry_sdk.init(
-    env('SENTRY_TOKEN'),
-    integrations=[AioHttpIntegration()]
-)
+# page_store и fetcher (вместе с aiohttp) импортируются при первом обращении
+def open_pages():
+    from page_store import open_store
+    return open_store(env.path('SEAFARER_DATA_DIR'), '{}.html', env('SEAFARER_STORE_DIR', None))
+
+def open_failures():
+    from fetcher import FailureJournal
+    return FailureJournal(env('SEAFARER_FAILURES', 'seafarer_failures.jsonl'))
+
+def open_manifest():
+    from fetcher import FetchManifest
+    return FetchManifest(env('SEAFARER_MANIFEST', 'seafarer_manifest.sqlite3'))
+
+pages = Lazy(open_pages)
+failures = Lazy(open_failures)
+manifest = Lazy(open_manifest)
 
 class BaseModel(Model):
     DATE_FORMAT = '%d.%m.%Y'
@@ -67,7 +81,7 @@ class ManagerOwner(BaseModel):
 class Vessel(BaseModel):
     name = CharField(null = True)
     href = CharField(null = True)
-    imo_number = IntegerField()
+    imo_number = IntegerField(null=True, unique=True)
     ship_type = ForeignKeyField(ShipType, null=True)
     gross_tonnage = CharField(null=True)
     dwt = CharField(null=True)
@@ -96,61 +110,89 @@ class ServiceRecord(BaseModel):
     from_date = DateField(formats=[BaseModel.DATE_FORMAT], null=True)
     to_date = DateField(formats=[BaseModel.DATE_FORMAT], null=True)
 
+URL_FORMAT = 'http://maritime-connector.com/seafarer/a/{0}'
 TOTAL_PAGE_COUNT = 163552
 LIMIT = 20
+BATCH_SIZE = env.int('SEAFARER_BATCH_SIZE', 500)
+PARSE_WORKERS = env.int('PARSE_WORKERS', 1)
+
+async def fetch(url, fetcher, key, refresh=False):
+    if refresh:
+        data = await fetcher.refresh(url, key=key)
+    else:
+        data = await fetcher.fetch(url, key=key)
+    if data is not None:
+        return key, data
+
+
+async def download_by_ids(urlformat, store, ids, pb_desc= 'Download', journal=failures, refresh=False, window=LIMIT):
+    """ Скачивание страниц по id, возвращает ключи записанных страниц
+
+    Одновременно выполняется не больше window запросов, следующие id
+    берутся из ids по мере освобождения мест, поэтому память не зависит
+    от длины ids. При refresh=True уже скачанные страницы запрашиваются
+    условно и перезаписываются, только если их содержимое изменилось.
+    """
+    from fetcher import Fetcher
+    from page_store import AsyncWriter
+
+    written = []
+    progress_bar = tqdm(total=len(ids) if hasattr(ids, '__len__') else None, desc=pb_desc)
+    ids = iter(ids)
+    in_flight = set()
+
+    async def download(url, fetcher, writer, key):
+        """ Скачивание и запись страницы в потоке writer, возвращает key или None """
+        result = await fetch(url, fetcher, key, refresh)
+        if result is not None:
+            await writer.put(key, result[1])
+            return key
+
+    with AsyncWriter(store) as writer:
+        async with Fetcher(limit=window, journal=journal, manifest=manifest, name='seafarers') as fetcher:
+            while True:
+                for _id in ids:
+                    key = str(_id)
+                    if not refresh and key in store:
+                        progress_bar.update()
+                        continue
+                    url = urlformat.format(_id)
+                    in_flight.add(asyncio.ensure_future(download(url, fetcher, writer, key)))
+                    if len(in_flight) >= window:
+                        break
+                if not in_flight:
+                    break
+
+                metrics.gauge('in_flight', len(in_flight), source='seafarers')
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = task.result()
+                    if key is not None:
+                        written.append(key)
+                    progress_bar.update()
+
+    progress_bar.close()
+    return written
+
+
+async def redrive_failures(urlformat, store, journal=failures):
+    """ Повторное скачивание страниц из журнала ошибок """
+    ids = [entry['key'] for entry in journal.entries() if 'key' in entry]
+    await download_by_ids(urlformat, store, ids, 'Redrive failures', journal)
+    journal.compact()
+
+
+async def refresh_seafarers(urlformat, store, ids):
+    """ Обновление изменившихся страниц и удаление их моряков из БД,
+    чтобы следующий запуск main() загрузил их заново """
+    changed = await download_by_ids(urlformat, store, ids, 'Refresh', refresh=True)
+    changed_ids = [int(key) for key in changed]
+    with db.atomic():
+        for chunk in peewee.chunked(changed_ids, BATCH_SIZE):
+            ServiceRecord.delete().where(ServiceRecord.seafarer.in_(chunk)).execute()
+            Seafarer.delete().where(Seafarer.id.in_(chunk)).execute()
+    return changed_ids
 
-semaphore = asyncio.Semaphore(LIMIT)
-
-async def fetch(url, session, filename):
-    try:
-        async with session.get(url, raise_for_status=True) as response:
-            data = await response.read()
-            return filename, data
-    except aiohttp.client_exceptions.ClientResponseError as cre:
-        if cre.status != 404:
-            raise
-
-
-async def bound_fetch(semaphore, url, session, filename):
-    async with semaphore:
-        return await fetch(url, session, filename)
-
-
-async def download_by_ids(urlformat, fileformat, ids, pb_desc= 'Download'):
-    tasks = []
-
-    async with aiohttp.ClientSession() as session:
-        for _id in ids:
-            filename = fileformat.format(_id)
-            if os.path.isfile(filename):
-                continue
-            url = urlformat.format(_id)
-            task = asyncio.ensure_future(bound_fetch(semaphore, url, session, filename))
-            tasks.append(task)
-        
-        progress_bar = tqdm(total=len(ids), desc=pb_desc)
-
-        for coro in asyncio.as_completed(tasks):
-            result = await coro
-            if result is not None:
-                filename, data = result                
-                with open(filename, 'w', encoding='utf-8') as file:
-                    file.write(data.decode('utf-8'))
-            progress_bar.update()
-
-
-# if __name__ == '__main__':
-#     try:
-#         loop = asyncio.get_event_loop()
-#         loop.run_until_complete(download_by_ids(
-#             'http://maritime-connector.com/seafarer/a/{0}',
-#             'test/{0}.html',
-#             range(TOTAL_PAGE_COUNT, TOTAL_PAGE_COUNT - 1, -1),
-#             'Download maritimes',
-#         ))
-#         sys.exit()
-#     except KeyboardInterrupt:
-#         pass
 
 def parse_personal_data(page):
     rows = get_part_by_name(page, 'personal_data')
@@ -236,7 +278,7 @@ def get_part_by_name(page, part_key):
     rows = parts[0].parent.find_next('table', {'class': 'cv-data-table'}).select('tr')
     return rows
 
-def parse_html(html):
+def parse_html_soup(html):
     page = BeautifulSoup(html, 'lxml')
     try:
         cv = page.find('div', {'id': 'personal-cv'})
@@ -255,77 +297,257 @@ def parse_html(html):
         'service_records': parse_service_records(page),
     }
 
-def parse_seafarers():
-    files = sorted(os.listdir(data_dir), key=lambda filename: int(filename.split('.html')[0]))
-    
-    for filename in tqdm(files, desc='Parsing seafarers'):
-        obj_id = int(filename.split('.html')[0])
-        try:
-            obj = Seafarer.get_by_id(obj_id)            
-            continue        
-        except Seafarer.DoesNotExist:
-            full_filename = f'{data_dir}/{filename}'            
-            html = open(full_filename, encoding='utf-8').read()
-            obj = parse_html(html)
-            if obj:
-                obj['id'] = obj_id
-                yield obj
-            else:
-                os.remove(full_filename)
+SECTION_HEADERS = {
+    'Personal data': 'personal_data',
+    'Passport': 'passport',
+    'Service records': 'service_records',
+}
+
+def get_sections(html):
+    """ Все разделы анкеты за один проход по документу lxml """
+    root = extract.parse_document(html)
+    return extract.Sections(root, 'h3', SECTION_HEADERS, 'cv-data-table', anchors={('div', 'personal-cv')})
+
+def personal_data_from_rows(rows):
+    if rows is None: return {}
+    name_to_key = {
+        'Current department': 'department',
+        'Current rank': 'rank',
+    }
+    obj = {}
+    for row in rows:
+        for cell in extract.child_elements(row):
+            cell_string = extract.element_string(cell)
+            if not cell_string:
+                continue
+            cell_text = cell_string.strip()
+
+            if cell_text in name_to_key.keys():
+                obj[name_to_key[cell_text]] = extract.element_string(extract.find_next(row, 'td')).strip()
+    return obj
+
+def passport_data_from_rows(rows):
+    if rows is None: return {}
+    name_to_key = {
+        'Nationality': 'nationality',
+    }
+    obj = {}
+    for row in rows:
+        offset = 0
+        for cell in extract.child_elements(row):
+            cell_string = extract.element_string(cell)
+            if not cell_string:
+                continue
+            cell_text = cell_string.strip()
+            if cell_text in name_to_key.keys():
+                data_cells = list(extract.find_next(row, 'tr').iterdescendants('td'))
+                obj[name_to_key[cell_text]] = extract.element_string(data_cells[offset]).strip()
+            offset += 1
+    return obj
+
+def service_records_from_rows(rows):
+    if rows is None : return []
+    name_to_key = {
+        'Department': 'department',
+        'Rank': 'rank',
+        'Ship type': 'ship_type',
+        'Vessel name': 'vessel_name',
+        'Company': 'company',
+        'From': 'from',
+        'To': 'to',
+    }
+    headers = [extract.element_text(cell) for cell in rows[0].iterdescendants('th')]
+    headers = [name_to_key[text] for text in headers if text]
+    obj = []
+    for row in rows[1:]:
+        record = []
+        for cell in row.iterdescendants('td'):
+            cell_string = extract.element_string(cell)
+            if cell_string:
+                record.append(cell_string.strip())
+                continue
+            link = extract.find_first(cell, 'a')
+            record.append(link.attrib['href'] if link is not None else None)
+        obj.append(dict(zip(headers, record)))
+    return obj
+
+def parse_html(html):
+    sections = get_sections(html)
+    try:
+        cv = sections.by_id.get('personal-cv')
+        title = extract.element_string(extract.find_first(extract.find_first(cv, 'div', 'description'), 'h2')).strip()
+    except AttributeError:
+        return None
+
+    personal_data = personal_data_from_rows(sections.rows('personal_data'))
+    passport_data = passport_data_from_rows(sections.rows('passport'))
+
+    return {
+        'title': title,
+        'department': personal_data.get('department', None),
+        'rank': personal_data.get('rank', None),
+        'nationality': passport_data.get('nationality', None),
+        'service_records': service_records_from_rows(sections.rows('service_records')),
+    }
+
+def get_loaded_ids():
+    """ Множество id уже загруженных моряков, одним потоковым запросом """
+    query = Seafarer.select(Seafarer.id).tuples()
+    return {obj_id for obj_id, in query.iterator()}
+
+def parse_seafarer_page(page):
+    """ Парсинг одной страницы, выполняется в процессе пула """
+    obj_id, data = page
+    started = time.perf_counter()
+    obj = parse_html(data.decode('utf-8'))
+    return obj_id, obj, time.perf_counter() - started
+
+def parse_seafarers(workers=PARSE_WORKERS, ordered=True):
+    loaded_ids = get_loaded_ids()
+    ids = (int(key) for key in pages.keys())
+    ids = sorted(obj_id for obj_id in ids if obj_id not in loaded_ids)
+    del loaded_ids
+
+    items = ((obj_id, pages.get(str(obj_id))) for obj_id in ids)
+    results = parallel_map(parse_seafarer_page, items, workers=workers, ordered=ordered)
+
+    for obj_id, obj, elapsed in tqdm(results, total=len(ids), desc='Parsing seafarers'):
+        metrics.observe('parse_seconds', elapsed, source='seafarers')
+        if obj:
+            obj['id'] = obj_id
+            yield obj
+        else:
+            pages.delete(str(obj_id))
 
 def test_seafarers():
     for obj in tqdm(Seafarer.select(Seafarer.id), desc='Testing seafarers'):
-        if not os.path.isfile(os.path.join(data_dir, f'{obj.id}.html')):
+        if str(obj.id) not in pages:
             yield {'error': f'no html file for id #{obj.id}'}
 
 def service_records():
-    files = sorted(os.listdir(data_dir), key=lambda filename: int(filename.split('.html')[0]))
-    
-    for filename in tqdm(files):
-        obj_id = filename.split('.html')[0]
-        full_filename = os.path.join(data_dir, f'{obj_id}.html')
-        html = open(full_filename, encoding='utf-8').read()
-        records = parse_service_records(BeautifulSoup(html, 'lxml'))
+    ids = sorted(int(key) for key in pages.keys())
+
+    for obj_id in tqdm(ids):
+        obj_id = str(obj_id)
+        html = pages.get(obj_id).decode('utf-8')
+        records = service_records_from_rows(get_sections(html).rows('service_records'))
         for record in records:
             yield obj_id, record
 
 
-def get_or_create(model, **kwargs):
-    kwargs = {k: v for k, v in kwargs.items() if v}
-    if not kwargs: return None
-    return model.get_or_create(**kwargs)[0]
+def get_dimension_caches(batch_size=1000):
+    return {
+        Department: DimensionCache(Department, batch_size=batch_size),
+        Rank: DimensionCache(Rank, batch_size=batch_size),
+        Nationality: DimensionCache(Nationality, batch_size=batch_size),
+        ShipType: DimensionCache(ShipType, batch_size=batch_size),
+        Company: DimensionCache(Company, batch_size=batch_size),
+        Vessel: DimensionCache(Vessel, fields=('name', 'href'), batch_size=batch_size),
+    }
 
-def main():
-    db.create_tables((Department, Rank, Nationality, ShipType, Company, ServiceRecord, Seafarer, Vessel))
+def seafarer_rows(seafarer, caches):
+    """ Строки Seafarer и ServiceRecord для вставки, id справочников берутся из кэша """
+    row = {
+        'id': seafarer['id'],
+        'name': seafarer['title'],
+        'department': caches[Department].get_id(name=seafarer['department']),
+        'rank': caches[Rank].get_id(name=seafarer['rank']),
+        'nationality': caches[Nationality].get_id(name=seafarer['nationality']),
+    }
 
-    for seafarer in parse_seafarers():
+    records = []
+    for record in seafarer['service_records']:
+        records.append({
+            'seafarer': seafarer['id'],
+            'department': caches[Department].get_id(name=record.get('department')),
+            'rank': caches[Rank].get_id(name=record.get('rank')),
+            'ship_type': caches[ShipType].get_id(name=record.get('ship_type')),
+            'vessel': caches[Vessel].get_id(name=record.get('vessel_name'))
+                if record.get('vessel_name') else caches[Vessel].get_id(href=record.get('vessel_href')),
+            'company': caches[Company].get_id(name=record.get('company')),
+            'from_date': record['from'] if record.get('from') else None,
+            'to_date': record['to'] if record.get('to') else None,
+        })
+    return row, records
+
+def write_batch(seafarers, records, caches, chunk_size=BATCH_SIZE):
+    """ Запись пачки моряков и их послужных записей в одной транзакции """
+    with metrics.timer('db_batch_seconds', source='seafarers'):
+        flush_dimension_caches(caches)
+        with db.atomic():
+            for chunk in peewee.chunked(seafarers, chunk_size):
+                Seafarer.insert_many(rows=chunk).execute()
+            for chunk in peewee.chunked(records, chunk_size):
+                ServiceRecord.insert_many(rows=chunk).execute()
+    metrics.inc('db_rows_total', len(seafarers), source='seafarers', table='seafarer')
+    metrics.inc('db_rows_total', len(records), source='seafarers', table='servicerecord')
+
+def main(batch_size=BATCH_SIZE):
+    metrics.start_reporting(env('METRICS_FILE', None))
+    db.create_tables((Department, Rank, Nationality, ShipType, Company, ServiceRecord, Seafarer, Vessel))
 
-        Seafarer.insert(
-            id=seafarer['id'],
-            name=seafarer['title'],
-            department=get_or_create(Department, name=seafarer['department']),
-            rank=get_or_create(Rank, name=seafarer['rank']),
-            nationality=get_or_create(Nationality, name=seafarer['nationality'])
-        ).execute()
-        
-        records = []
-        for record in seafarer['service_records']:        
-            records.append({
-                ServiceRecord.seafarer: Seafarer.get_by_id(seafarer['id']),
-                'department': get_or_create(Department, name=record['department']) if record.get('department') else None,
-                'rank': get_or_create(Rank, name=record['rank']) if record.get('rank') else None,
-                'ship_type': get_or_create(ShipType, name=record['ship_type']) if record.get('ship_type') else None,
-                'vessel': get_or_create(Vessel, name=record.get('vessel_name'))
-                    if record.get('vessel_name') else get_or_create(Vessel, href=record.get('vessel_href')),
-                'company': get_or_create(Company, name=record['company']) if record.get('company') else None,
-                'from_date': record['from'] if record.get('from') else None,
-                'to_date': record['to'] if record.get('to') else None,
-            })
-        ServiceRecord.insert_many(rows=records).execute()
+    caches = get_dimension_caches()
 
-if __name__ == '__main__':
-    from playhouse.migrate import migrate, MySQLMigrator
+    seafarers = []
+    records = []
+    for seafarer in parse_seafarers():
+        row, seafarer_records = seafarer_rows(seafarer, caches)
+        seafarers.append(row)
+        records.extend(seafarer_records)
+
+        if len(seafarers) >= batch_size:
+            write_batch(seafarers, records, caches)
+            seafarers = []
+            records = []
+
+    if seafarers:
+        write_batch(seafarers, records, caches)
+
+    print('proccess finished')
+
+def load_seafarers(batch, caches):
+    """ Стадия загрузки конвейера: пачка (key, obj) -> Seafarer и ServiceRecord """
+    seafarers = []
+    records = []
+    for key, seafarer in batch:
+        seafarer['id'] = int(key)
+        row, seafarer_records = seafarer_rows(seafarer, caches)
+        seafarers.append(row)
+        records.extend(seafarer_records)
+    write_batch(seafarers, records, caches)
+
+async def run_pipeline(ids, fetch_workers=LIMIT, parse_workers=PARSE_WORKERS, batch_size=BATCH_SIZE, queue_size=100):
+    """ Скачивание, парсинг и загрузка моряков одновременно
+
+    Уже загруженные в БД id пропускаются, уже скачанные страницы берутся
+    из pages, новые страницы дописываются в pages.
+    """
+    import pipeline
+    from fetcher import Fetcher
+
+    metrics.start_reporting(env('METRICS_FILE', None))
+    db.create_tables((Department, Rank, Nationality, ShipType, Company, ServiceRecord, Seafarer, Vessel))
 
+    caches = get_dimension_caches()
+    loaded_ids = get_loaded_ids()
+    items = ((str(_id), URL_FORMAT.format(_id)) for _id in ids if _id not in loaded_ids)
+
+    async with Fetcher(limit=fetch_workers, journal=failures, manifest=manifest, name='seafarers') as fetcher:
+        return await pipeline.run(
+            items,
+            lambda key, url: fetcher.fetch(url, key=key),
+            parse_seafarer_page,
+            lambda batch: load_seafarers(batch, caches),
+            archive=pages,
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            batch_size=batch_size,
+            queue_size=queue_size,
+            source='seafarers',
+        )
+
+def migrate_vessels():
+    """ Добавление в таблицу vessel колонок с данными кораблей """
     migrator = MySQLMigrator(db)
     imo_number_field = IntegerField(null=True)
     ship_type_field = ForeignKeyField(ShipType, null=True)
@@ -341,6 +563,6 @@ if __name__ == '__main__':
         migrator.add_column('vessel', 'managerowner', managerowner_field),
     )
 
-print('proccess finished')
-
-    
\ No newline at end of file
+if __name__ == '__main__':
+    import cli
+    cli.main(['seafarers', *(sys.argv[1:] or ['load'])])
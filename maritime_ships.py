@@ -1,95 +1,184 @@
-import aiohttp
 import asyncio
 import os
 import sys
-import sentry_sdk
 from tqdm import tqdm
 from environs import Env
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 import hashlib
 import peewee
-from peewee import Model, IntegerField, CharField, ForeignKeyField
+from peewee import Model, IntegerField, CharField, ForeignKeyField, fn
 from playhouse.db_url import connect
 from playhouse.shortcuts import model_to_dict, dict_to_model
-from playhouse.migrate import migrate, MySQLMigrator
+from playhouse.migrate import migrate, MySQLMigrator, SchemaMigrator
+from parallel import parallel_map
+from runtime import Lazy, LazyDatabase
+from dimensions import DimensionCache, flush_dimension_caches
+from frontier import Frontier, PENDING, FETCHED, FAILED, EMPTY
+import metrics
+import time
+import extract
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from fetcher import Fetcher, FailureJournal
 
 env = Env()
 env.read_env('dev.env')
 
-sentry_sdk.init(
-    os.environ.get('SENTRY_TOKEN'),
-    integrations=[sentry_sdk.integrations.aiohttp.AioHttpIntegration()]
-)
+PARSE_WORKERS = env.int('PARSE_WORKERS', 1)
 
-def url_generator():
-    """ Генератор ссылок на корабли
-    
-    Проходит по всем страницам кораблей и из каждой страницы извлекает
-    все ссылки на корабли.
-    """
+
+# page_store и fetcher (вместе с aiohttp) импортируются при первом обращении
+def open_pages():
+    from page_store import open_store
+    return open_store(env.path('SHIP_DATA_DIR'), '{}', env('SHIP_STORE_DIR', None))
+
+def open_failures():
+    from fetcher import FailureJournal
+    return FailureJournal(env('SHIP_FAILURES', 'ship_failures.jsonl'))
+
+def open_manifest():
+    from fetcher import FetchManifest
+    return FetchManifest(env('SHIP_MANIFEST', 'ship_manifest.sqlite3'))
+
+pages = Lazy(open_pages)
+failures = Lazy(open_failures)
+manifest = Lazy(open_manifest)
+frontier = Lazy(lambda: Frontier(env('SHIP_FRONTIER', 'ship_frontier.sqlite3')))
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36'
+}
+CONSUMER_COUNT = 20
+VESSEL_BATCH_SIZE = env.int('VESSEL_BATCH_SIZE', 1000)
+FRONTIER_BATCH_SIZE = 1000
+
+def parse_listing(html):
+    """ Ссылки на корабли со страницы списка """
+    page = BeautifulSoup(html, 'lxml')
+    items = page.find('ul', {'id': 'results-list'}).find_all('li')
+    urls = []
+    for item in items:
+        if not isinstance(item, Tag):
+            continue
+        urls.append(item.find('a').attrs['href'])
+    return urls
+
+def discover_urls(frontier=frontier):
+    """ Добавление в frontier ссылок со страниц списка, которые ещё не разбирались
+    (или изменились с прошлого разбора) """
     for entry in os.scandir(env.path('SHIP_PAGE_DATA_DIR')):
         if not entry.name.endswith('.html'): continue
-        html = open(entry.path, 'r', encoding='utf-8').read()                
-        page = BeautifulSoup(html, 'lxml')
-        items = page.find('ul', {'id': 'results-list'}).find_all('li')
-        urls = []
-        for item in items:
-            if not isinstance(item, Tag):
-                continue
-            urls.append(item.find('a').attrs['href'])
-        yield from urls
+        mtime = entry.stat().st_mtime
+        if frontier.listing_parsed(entry.name, mtime): continue
+        with open(entry.path, 'r', encoding='utf-8') as file:
+            urls = parse_listing(file.read())
+        frontier.add(urls, listing=entry.name, mtime=mtime)
 
-async def fetch(url, session: aiohttp.ClientSession):
+def frontier_urls(statuses=(PENDING,), frontier=frontier):
+    """ Ссылки из frontier с заданными статусами, новые страницы списка разбираются перед этим """
+    discover_urls(frontier)
+    for batch in frontier.batches(statuses, FRONTIER_BATCH_SIZE):
+        yield from batch
+
+async def fetch(url, fetcher: 'Fetcher', refresh=False):
     """ Функция для скачивания файла по его URL.
 
-    В случае возникновения ошибок логгирует их в SENTRY.
+    Повторяет запрос при временных ошибках, окончательные ошибки
+    логгирует в SENTRY и записывает в журнал ошибок. При refresh=True
+    выполняет условный запрос и возвращает данные, только если страница изменилась.
+    Результат записывается в frontier.
     """
-    try:
-        async with session.get(url, raise_for_status=True) as response:
-            return await response.read()            
-    except aiohttp.client_exceptions.ClientResponseError as cre:
-        sentry_sdk.capture_exception(cre)
+    if refresh:
+        data = await fetcher.refresh(url)
+    else:
+        data = await fetcher.fetch(url)
+    if url in failures.failed:
+        frontier.mark(url, FAILED)
+    elif data is not None or refresh:
+        frontier.mark(url, FETCHED)
+    else:
+        frontier.mark(url, EMPTY)
+    return data
 
-def get_filename_for_write(url):
-    """ Функция для генерации имени файла по его URL.
+def get_page_key(url):
+    """ Функция для генерации ключа страницы по её URL.
 
-    Используется для сохранения скачанных файлов, а также
+    Используется для сохранения скачанных страниц, а также
     для предотвращения повторного скачивания.
     """
-    filehash = hashlib.md5(url.encode('utf-8')).hexdigest()
-    return os.path.join(env.path('SHIP_DATA_DIR'), filehash)
+    return hashlib.md5(url.encode('utf-8')).hexdigest()
 
 def url_is_fetched(url):
-    """ Функция для проверки, скачан файл или нет.
+    """ Функция для проверки, скачана страница или нет.
     """
-    filename = get_filename_for_write(url)
-    if os.path.isfile(filename):
-        return True
-    return False
-
-async def producer(q: asyncio.Queue):
-    """ Реализация Producer """
-    for url in tqdm(url_generator(), desc='producer'):
+    return get_page_key(url) in pages
+
+async def producer(q: asyncio.Queue, statuses=(PENDING,)):
+    """ Реализация Producer: ещё не скачанные ссылки из frontier """
+    for url in tqdm(frontier_urls(statuses), desc='producer'):
         await q.put(url)
+        metrics.gauge('queue_depth', q.qsize(), source='ships')
+
+async def refresh_producer(q: asyncio.Queue):
+    """ Producer для обновления: и новые, и уже скачанные ссылки """
+    await producer(q, (PENDING, FETCHED))
 
-async def consumer(q: asyncio.Queue, name):
-    """ Реализация Consumer """
+async def consumer(q: asyncio.Queue, name, fetcher: 'Fetcher', refresh=False, written=None, writer=None):
+    """ Реализация Consumer; страницы записываются через writer (AsyncWriter), если он задан """
     progress = tqdm(desc=f'consumer #{name}', leave=False)
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36'
-    }
-    async with aiohttp.ClientSession(headers=headers) as session:
-        while True:
-            url = await q.get()
-            if url_is_fetched(url):
-                q.task_done()
-                continue
-                data = await fetch(url, session)
-                with open(get_filename_for_write(url), 'w', encoding='utf-8') as file:
-                    file.write(data.decode('utf-8'))
-            progress.update()
+    while True:
+        url = await q.get()
+        metrics.gauge('queue_depth', q.qsize(), source='ships')
+        if not refresh and url_is_fetched(url):
+            frontier.mark(url, FETCHED, attempt=False)
             q.task_done()
+            continue
+        data = await fetch(url, fetcher, refresh)
+        if data is not None:
+            key = get_page_key(url)
+            if writer is not None:
+                await writer.put(key, data)
+            else:
+                pages.put(key, data)
+            if written is not None:
+                written.append(key)
+        progress.update()
+        q.task_done()
+
+async def failures_producer(q: asyncio.Queue, journal: 'FailureJournal' = failures):
+    """ Producer для повторного скачивания URL из журнала ошибок """
+    for entry in tqdm(journal.entries(), desc='redrive'):
+        await q.put(entry['url'])
+
+async def download(producer=producer, refresh=False):
+    """ Асинхронное скачивание кораблей через общий пул соединений
+
+    Возвращает ключи записанных страниц. При refresh=True уже скачанные
+    страницы запрашиваются условно и перезаписываются только при изменении.
+    """
+    from fetcher import Fetcher
+    from page_store import AsyncWriter
+
+    q = asyncio.Queue(maxsize=40)
+    written = []
+
+    with AsyncWriter(pages) as writer:
+        async with Fetcher(headers=HEADERS, limit=CONSUMER_COUNT, journal=failures, manifest=manifest, name='ships') as fetcher:
+            producer_task = asyncio.create_task(producer(q))
+            consumers = [
+                asyncio.create_task(consumer(q, name, fetcher, refresh, written, writer))
+                for name in range(CONSUMER_COUNT)
+            ]
+
+            await producer_task
+            await q.join()
+            for consumer_task in consumers:
+                consumer_task.cancel()
+    frontier.commit()
+
+    return written
 
 def get_part_by_name(page: BeautifulSoup, part_key: str):
     """ Получение таблицы с данными по имени раздела """
@@ -106,20 +195,22 @@ def get_part_by_name(page: BeautifulSoup, part_key: str):
     rows = parts[0].parent.find_next('table', {'class': 'ship-data-table'}).select('tr')
     return rows
 
+SHIP_INFO_FIELDS = {
+    'IMO number': {'key': 'imo_number', 'fn': int},
+    'Name of the ship': 'name',
+    'Type of ship': 'ship_type',
+    'Gross tonnage': 'gross_tonnage',
+    'DWT': 'dwt',
+    'Manager': 'manager',
+    'Owner': 'owner',
+    'Manager & owner': 'managerowner',
+}
+
 def parse_info(page: BeautifulSoup) -> dict:
     """ Парсинг страницы """
     rows = get_part_by_name(page, 'ship_info')
     if rows is None: return {}
-    name_to_key = {
-        'IMO number': {'key': 'imo_number', 'fn': int},
-        'Name of the ship': 'name',
-        'Type of ship': 'ship_type',
-        'Gross tonnage': 'gross_tonnage',
-        'DWT': 'dwt',
-        'Manager': 'manager',
-        'Owner': 'owner',
-        'Manager & owner': 'managerowner',
-    }
+    name_to_key = SHIP_INFO_FIELDS
     obj = {}
     for row in rows:
         for cell in row.children:
@@ -144,18 +235,54 @@ def parse_info(page: BeautifulSoup) -> dict:
                     return {}
     return obj
 
-def ship_generator():
-    """ Проход по всем имеющимся файлам с кораблями, парсинг, генерация, удаление 'пустых' файлов """
-    for entry in os.scandir(env.path('SHIP_DATA_DIR')):
-        html = open(entry.path, 'r', encoding='utf-8').read()
-        page = BeautifulSoup(html, 'lxml')
-        info = parse_info(page)
+def parse_info_html(html) -> dict:
+    """ Парсинг страницы за один проход по дереву lxml, результат как у parse_info """
+    root = extract.parse_document(html)
+    sections = extract.Sections(root, 'h3', {'Ship info': 'ship_info'}, 'ship-data-table', prefix=True)
+    rows = sections.rows('ship_info')
+    if rows is None: return {}
+    obj = {}
+    for row in rows:
+        for cell in extract.child_elements(row):
+            cell_string = extract.element_string(cell)
+            if not cell_string:
+                continue
+            cell_text = cell_string.strip()
+
+            if cell_text in SHIP_INFO_FIELDS.keys():
+                try:
+                    value = extract.element_string(extract.find_next(row, 'td')).strip()
+                    if 'key' in SHIP_INFO_FIELDS[cell_text]:
+                        key = SHIP_INFO_FIELDS[cell_text]['key']
+                        fn = SHIP_INFO_FIELDS[cell_text]['fn']
+                    else:
+                        key = SHIP_INFO_FIELDS[cell_text]
+                        fn = None
+
+                    obj[key] = fn(value) if fn else value
+                except AttributeError:
+                    return {}
+    return obj
+
+def parse_ship_page(page):
+    """ Парсинг одной страницы, выполняется в процессе пула """
+    key, data = page
+    started = time.perf_counter()
+    info = parse_info_html(data.decode('utf-8'))
+    return key, info, time.perf_counter() - started
+
+def ship_generator(workers=PARSE_WORKERS, ordered=False, keys=None):
+    """ Проход по всем имеющимся страницам с кораблями (или только по keys),
+    парсинг, генерация, удаление 'пустых' страниц """
+    items = pages.items() if keys is None else ((key, pages.get(key)) for key in keys)
+    for key, info, elapsed in parallel_map(parse_ship_page, items, workers=workers, ordered=ordered):
+        metrics.observe('parse_seconds', elapsed, source='ships')
         if not bool(info):
-            os.remove(entry.path)
+            pages.delete(key)
             continue
         yield info
 
-db = connect(env('DATABASE_URL'))
+db = LazyDatabase(lambda: connect(env('DATABASE_URL')))
 
 class BaseModel(Model):
     class Meta:
@@ -188,7 +315,7 @@ class ManagerOwner(BaseModel):
 class Vessel(BaseModel):
     name = CharField(null = True)
     href = CharField(null = True)
-    imo_number = IntegerField()
+    imo_number = IntegerField(null=True, unique=True)
     ship_type = ForeignKeyField(ShipType, null=True)
     gross_tonnage = CharField(null=True)
     dwt = CharField(null=True)
@@ -199,23 +326,128 @@ class Vessel(BaseModel):
     def __str__(self):
         return self.name if self.name else self.href
 
-def get_or_create(model, **kwargs):
-    kwargs = {k: v for k, v in kwargs.items() if v}
-    if not kwargs: return None
-    return model.get_or_create(**kwargs)[0]
+VESSEL_FIELDS = ('name', 'ship_type', 'gross_tonnage', 'dwt', 'manager', 'owner', 'managerowner')
+
+def get_dimension_caches(batch_size=1000):
+    return {
+        ShipType: DimensionCache(ShipType, batch_size=batch_size),
+        Manager: DimensionCache(Manager, batch_size=batch_size),
+        Owner: DimensionCache(Owner, batch_size=batch_size),
+        ManagerOwner: DimensionCache(ManagerOwner, batch_size=batch_size),
+    }
 
-async def main():
+def vessel_row(ship, caches):
+    """ Строка Vessel для upsert, id справочников берутся из кэша """
+    return {
+        'imo_number': ship['imo_number'],
+        'name': ship['name'] if ship.get('name') else None,
+        'ship_type': caches[ShipType].get_id(name=ship.get('ship_type')),
+        'gross_tonnage': ship['gross_tonnage'] if ship.get('gross_tonnage') else None,
+        'dwt': ship['dwt'] if ship.get('dwt') else None,
+        'manager': caches[Manager].get_id(name=ship.get('manager')),
+        'owner': caches[Owner].get_id(name=ship.get('owner')),
+        'managerowner': caches[ManagerOwner].get_id(name=ship.get('managerowner')),
+    }
+
+def upsert_vessels(rows, chunk_size=VESSEL_BATCH_SIZE):
+    """ INSERT ... ON DUPLICATE KEY UPDATE по уникальному индексу imo_number
+    (ON CONFLICT (imo_number) DO UPDATE для SQLite) """
+    preserve = [getattr(Vessel, field) for field in VESSEL_FIELDS]
+    for chunk in peewee.chunked(rows, chunk_size):
+        query = Vessel.insert_many(rows=chunk)
+        if isinstance(db.obj, peewee.MySQLDatabase):
+            query = query.on_conflict(preserve=preserve)
+        else:
+            query = query.on_conflict(conflict_target=[Vessel.imo_number], preserve=preserve)
+        query.execute()
+
+def write_vessels(ships, caches):
+    """ Запись пачки кораблей: новые значения справочников и upsert в одной транзакции """
+    rows = {}
+    for ship in ships:
+        if ship.get('imo_number'):
+            rows[ship['imo_number']] = vessel_row(ship, caches)
+    with metrics.timer('db_batch_seconds', source='ships'):
+        flush_dimension_caches(caches)
+        with db.atomic():
+            upsert_vessels(list(rows.values()))
+    metrics.inc('db_rows_total', len(rows), source='ships', table='vessel')
+
+def load(keys=None, batch_size=VESSEL_BATCH_SIZE):
+    """ Обновление в БД информации по кораблям со всех страниц или только с keys """
+    caches = get_dimension_caches()
+    total = len(pages) if keys is None else len(keys)
+    batch = []
+    for ship in tqdm(ship_generator(keys=keys), total=total):
+        batch.append(ship)
+        if len(batch) >= batch_size:
+            write_vessels(batch, caches)
+            batch = []
+    if batch:
+        write_vessels(batch, caches)
+
+def add_imo_number_index():
+    """ Уникальный индекс по vessel.imo_number
+
+    Дубликаты по imo_number сводятся к строке с наименьшим id, ссылки на
+    удаляемые строки из servicerecord переносятся на неё.
+    """
+    db.connect(reuse_if_open=True)
+    duplicates = (Vessel
+        .select(Vessel.imo_number, fn.MIN(Vessel.id))
+        .where(Vessel.imo_number.is_null(False))
+        .group_by(Vessel.imo_number)
+        .having(fn.COUNT(Vessel.id) > 1)
+        .tuples())
+    service_record = peewee.Table('servicerecord', ('id', 'vessel_id')).bind(db)
+    with db.atomic():
+        for imo_number, keep_id in list(duplicates):
+            query = Vessel.select(Vessel.id).where((Vessel.imo_number == imo_number) & (Vessel.id != keep_id))
+            ids = [vessel_id for vessel_id, in query.tuples()]
+            if db.table_exists('servicerecord'):
+                service_record.update({service_record.vessel_id: keep_id}).where(service_record.vessel_id.in_(ids)).execute()
+            Vessel.delete().where(Vessel.id.in_(ids)).execute()
+
+    migrator = SchemaMigrator.from_database(db.obj)
+    migrate(migrator.add_index('vessel', ('imo_number',), True))
+
+async def run_pipeline(urls=None, fetch_workers=CONSUMER_COUNT, parse_workers=PARSE_WORKERS, batch_size=VESSEL_BATCH_SIZE, queue_size=100):
+    """ Скачивание, парсинг и загрузка кораблей одновременно
+
+    Ссылки по умолчанию - ещё не скачанные из frontier. Уже скачанные
+    страницы берутся из pages и отмечаются во frontier без запроса, новые
+    дописываются в pages.
+    """
+    import pipeline
+    from fetcher import Fetcher
+
+    metrics.start_reporting(env('METRICS_FILE', None))
+    caches = get_dimension_caches()
+    urls = frontier_urls() if urls is None else urls
+    items = ((get_page_key(url), url) for url in urls)
+
+    async with Fetcher(headers=HEADERS, limit=fetch_workers, journal=failures, manifest=manifest, name='ships') as fetcher:
+        loaded = await pipeline.run(
+            items,
+            lambda key, url: fetch(url, fetcher),
+            parse_ship_page,
+            lambda batch: write_vessels([ship for _, ship in batch], caches),
+            archive=pages,
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            batch_size=batch_size,
+            queue_size=queue_size,
+            source='ships',
+            on_archived=lambda key, url: frontier.mark(url, FETCHED, attempt=False),
+        )
+    frontier.commit()
+    return loaded
+
+async def main(refresh=False):
+    metrics.start_reporting(env('METRICS_FILE', None))
     try:
         """ Асинхронное скачивание кораблей """
-        q = asyncio.Queue(maxsize=40)
-        
-        producer_task = asyncio.create_task(producer(q))
-        consumers = [asyncio.create_task(consumer(q, name)) for name in range(20)]
-        
-        await producer_task
-        await q.join()
-        for consumer_task in consumers:
-            consumer_task.cancel()
+        written = await download(refresh_producer if refresh else producer, refresh)
 
         # migrator = MySQLMigrator(db)
         # db.create_tables([ManagerOwner])
@@ -227,21 +459,12 @@ async def main():
         # ) 
         
         """ Обновление в БД информации по кораблям """
-        total = len(os.listdir(env.path('SHIP_DATA_DIR')))
-        for ship in tqdm(ship_generator(), total=total):
-            v = get_or_create(Vessel, imo_number=ship['imo_number'])
-            v.name = ship['name'] if ship.get('name') else None
-            v.ship_type = get_or_create(ShipType, name=ship['ship_type']) if ship.get('ship_type') else None
-            v.gross_tonnage = ship['gross_tonnage'] if ship.get('gross_tonnage') else None
-            v.dwt = ship['dwt'] if ship.get('dwt') else None
-            v.manager = get_or_create(Manager, name=ship['manager']) if ship.get('manager') else None
-            v.owner = get_or_create(Owner, name=ship['owner']) if ship.get('owner') else None
-            v.managerowner = get_or_create(ManagerOwner, name=ship['managerowner']) if ship.get('managerowner') else None
-            v.save()
+        load(written if refresh else None)
             
         print('proccess finished')
     except KeyboardInterrupt:
         print('proccess interrupted')
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    import cli
+    cli.main(['ships', 'run', *sys.argv[1:]])
@@ -0,0 +1,201 @@
+""" Метрики стадий скачивания, парсинга и загрузки в БД
+
+Счётчики, гистограммы и текущие значения с метками. Периодически
+записываются в файл в формате Prometheus (text exposition) или JSON,
+если имя файла оканчивается на .json, а при завершении процесса
+печатается краткая сводка.
+
+    metrics.observe('fetch_seconds', elapsed, source='ships', status=200)
+    metrics.gauge('queue_depth', q.qsize(), source='ships')
+    with metrics.timer('db_batch_seconds', table='seafarer'):
+        ...
+    metrics.start_reporting('metrics.prom', interval=10)
+"""
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def quantile(self, q):
+        """ Приблизительный квантиль: верхняя граница соответствующей корзины """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.reporter = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        def labels(key):
+            return dict(key[1])
+
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': [
+                    {'name': key[0], 'labels': labels(key), 'value': value}
+                    for key, value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    {'name': key[0], 'labels': labels(key), 'value': value}
+                    for key, value in sorted(self.gauges.items())
+                ],
+                'histograms': [
+                    {
+                        'name': key[0], 'labels': labels(key),
+                        'count': histogram.count, 'sum': histogram.sum,
+                        'buckets': [
+                            [bound if bound != float('inf') else '+Inf', count]
+                            for bound, count in zip(histogram.buckets, histogram.counts)
+                        ],
+                    }
+                    for key, histogram in sorted(self.histograms.items())
+                ],
+            }
+
+    def prometheus(self):
+        def format_labels(labels, **extra):
+            labels = {**labels, **extra}
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        for kind, items in (('counter', snapshot['counters']), ('gauge', snapshot['gauges'])):
+            for name in sorted({item['name'] for item in items}):
+                lines.append(f'# TYPE {name} {kind}')
+                for item in items:
+                    if item['name'] == name:
+                        lines.append(f'{name}{format_labels(item["labels"])} {item["value"]}')
+        histograms = snapshot['histograms']
+        for name in sorted({item['name'] for item in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for item in histograms:
+                if item['name'] != name:
+                    continue
+                cumulative = 0
+                for bound, count in item['buckets']:
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(item["labels"], le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(item["labels"])} {item["sum"]}')
+                lines.append(f'{name}_count{format_labels(item["labels"])} {item["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Атомарная запись метрик в файл: JSON для *.json, иначе формат Prometheus """
+        path = str(path)
+        if path.endswith('.json'):
+            content = json.dumps(self.snapshot(), indent=2)
+        else:
+            content = self.prometheus()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        for (name, labels), value in counters:
+            lines.append(f'{name} {dict(labels)}: {value}')
+        for (name, labels), histogram in histograms:
+            average = histogram.sum / histogram.count if histogram.count else 0.0
+            lines.append(
+                f'{name} {dict(labels)}: count {histogram.count}, total {histogram.sum:.3f} s, '
+                f'avg {average:.4f} s, p50 <= {histogram.quantile(0.5)} s, p95 <= {histogram.quantile(0.95)} s'
+            )
+        return '\n'.join(lines)
+
+    def start_reporting(self, path=None, interval=10.0, summary=True):
+        """ Периодическая запись в path (если задан) и сводка при выходе """
+        if self.reporter is not None:
+            return
+        self.reporter = threading.Event()
+
+        if path:
+            def report():
+                while not self.reporter.wait(interval):
+                    self.write(path)
+            threading.Thread(target=report, daemon=True).start()
+
+        def finish():
+            self.reporter.set()
+            if path:
+                self.write(path)
+            if summary and (self.counters or self.histograms):
+                print('\nMetrics summary:\n' + self.summary(), file=sys.stderr)
+        atexit.register(finish)
+
+
+registry = Registry()
+
+inc = registry.inc
+gauge = registry.gauge
+observe = registry.observe
+timer = registry.timer
+start_reporting = registry.start_reporting
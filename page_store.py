@@ -0,0 +1,334 @@
+""" Хранилища скачанных страниц
+
+DirectoryStore - прежний формат, один файл на страницу.
+PackedStore - страницы сжимаются zlib и дописываются в файлы-сегменты,
+а смещения хранятся в append-only индексе. Поддерживает чтение по ключу
+и быстрый последовательный проход по всем страницам.
+
+Ключ страницы - строка: id моряка или md5 от URL корабля.
+
+Проверка "страница уже скачана?" в обоих хранилищах - поиск в памяти:
+DirectoryStore один раз читает каталог через os.scandir в DirectoryManifest.
+
+AsyncWriter выполняет запись в хранилище в отдельном потоке, чтобы не
+блокировать цикл событий asyncio во время скачивания.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+
+class DirectoryManifest:
+    """ Ключи файлов каталога в памяти
+
+    Каталог читается одним os.scandir при первом обращении, дальше множество
+    обновляется через add() и discard() при записи и удалении. Файлы,
+    записанные в каталог в обход хранилища, видны только после rescan().
+    Скрытые файлы (в том числе временные .tmp-*) пропускаются.
+    """
+    def __init__(self, directory, prefix='', suffix=''):
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def rescan(self):
+        keys = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                if name.startswith(self.prefix) and name.endswith(self.suffix) and entry.is_file():
+                    keys.add(name[len(self.prefix):len(name) - len(self.suffix)])
+        self._keys = keys
+        return keys
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self.rescan()
+        return self._keys
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def add(self, key):
+        self.keys.add(key)
+
+    def discard(self, key):
+        self.keys.discard(key)
+
+
+class DirectoryStore:
+    """ Одна страница - один файл в каталоге """
+    def __init__(self, directory, filename_format='{}'):
+        self.directory = str(directory)
+        self.filename_format = filename_format
+        prefix, _, suffix = filename_format.partition('{}')
+        self.prefix = prefix
+        self.suffix = suffix
+        self.manifest = DirectoryManifest(self.directory, prefix, suffix)
+
+    def path(self, key):
+        return os.path.join(self.directory, self.filename_format.format(key))
+
+    def __contains__(self, key):
+        return key in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def keys(self):
+        return list(self.manifest)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        """ Запись во временный файл и атомарное переименование, поэтому после
+        сбоя в каталоге не бывает недописанных страниц """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.manifest.add(key)
+
+    def delete(self, key):
+        os.remove(self.path(key))
+        self.manifest.discard(key)
+
+    def items(self):
+        for key in self.keys():
+            data = self.get(key)
+            if data is not None:
+                yield key, data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedStore:
+    """ Сжатые страницы в файлах-сегментах с индексом смещений
+
+    Индекс - текстовый файл со строками "ключ сегмент смещение длина",
+    удаление записывается строкой "ключ -". При открытии индекс читается
+    целиком в память. Писать в хранилище должен только один процесс.
+    """
+    INDEX_FILENAME = 'index'
+    SEGMENT_FORMAT = 'segment-{:05d}.dat'
+
+    def __init__(self, directory, segment_size=256 * 1024 * 1024, compress_level=6):
+        self.directory = str(directory)
+        self.segment_size = segment_size
+        self.compress_level = compress_level
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.index = {}
+        self.segment = 0
+        self._load_index()
+
+        self._index_file = open(os.path.join(self.directory, self.INDEX_FILENAME), 'a', encoding='utf-8')
+        self._segment_file = None
+        self._readers = {}
+
+    def _load_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILENAME)
+        if not os.path.isfile(path):
+            return
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == '-':
+                    self.index.pop(parts[0], None)
+                elif len(parts) == 4:
+                    key, segment, offset, length = parts
+                    self.index[key] = (int(segment), int(offset), int(length))
+                    self.segment = max(self.segment, int(segment))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, self.SEGMENT_FORMAT.format(segment))
+
+    def _writer(self):
+        if self._segment_file is None:
+            self._segment_file = open(self._segment_path(self.segment), 'ab')
+        if self._segment_file.tell() >= self.segment_size:
+            self._segment_file.close()
+            self.segment += 1
+            self._segment_file = open(self._segment_path(self.segment), 'ab')
+        return self._segment_file
+
+    def _reader(self, segment):
+        if segment not in self._readers:
+            self._readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return self._readers[segment]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def get(self, key):
+        if key not in self.index:
+            return None
+        segment, offset, length = self.index[key]
+        if self._segment_file is not None and segment == self.segment:
+            self._segment_file.flush()
+        return zlib.decompress(os.pread(self._reader(segment), length, offset))
+
+    def put(self, key, data):
+        """ Сначала пишутся данные, затем строка индекса, поэтому после сбоя
+        в индексе не бывает ссылок на недописанные страницы """
+        compressed = zlib.compress(data, self.compress_level)
+        file = self._writer()
+        offset = file.tell()
+        file.write(compressed)
+        file.flush()
+        self.index[key] = (self.segment, offset, len(compressed))
+        self._index_file.write(f'{key} {self.segment} {offset} {len(compressed)}\n')
+        self._index_file.flush()
+
+    def delete(self, key):
+        if self.index.pop(key, None) is not None:
+            self._index_file.write(f'{key} -\n')
+            self._index_file.flush()
+
+    def items(self):
+        """ Последовательный проход по сегментам в порядке записи """
+        if self._segment_file is not None:
+            self._segment_file.flush()
+        entries = sorted(self.index.items(), key=lambda item: item[1])
+        segment = None
+        file = None
+        try:
+            for key, (entry_segment, offset, length) in entries:
+                if entry_segment != segment:
+                    if file is not None:
+                        file.close()
+                    segment = entry_segment
+                    file = open(self._segment_path(segment), 'rb')
+                if file.tell() != offset:
+                    file.seek(offset)
+                yield key, zlib.decompress(file.read(length))
+        finally:
+            if file is not None:
+                file.close()
+
+    def close(self):
+        self._index_file.close()
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment_file = None
+        for fd in self._readers.values():
+            os.close(fd)
+        self._readers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncWriter:
+    """ Запись в хранилище из asyncio без блокировки цикла событий
+
+        writer = AsyncWriter(pages)
+        await writer.put(key, data)
+        writer.close()
+
+    put(), delete() и get() выполняются в пуле из workers потоков; для
+    PackedStore, в который пишет только один поток, workers должен быть 1 -
+    тогда чтение не пересекается со сменой сегмента при записи.
+    """
+    def __init__(self, store, workers=1):
+        self.store = store
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def put(self, key, data):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.store.put, key, data)
+
+    async def delete(self, key):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.store.delete, key)
+
+    async def get(self, key):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.store.get, key)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_store(directory, filename_format='{}', packed_directory=None):
+    """ PackedStore, если задан каталог для него, иначе DirectoryStore """
+    if packed_directory:
+        return PackedStore(packed_directory)
+    return DirectoryStore(directory, filename_format)
+
+
+def migrate(source, target):
+    """ Перенос страниц из одного хранилища в другое, уже перенесённые пропускаются """
+    for key in tqdm(list(source.keys()), desc='Migrating pages'):
+        if key in target:
+            continue
+        data = source.get(key)
+        if data is not None:
+            target.put(key, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перенос страниц из каталога в PackedStore')
+    parser.add_argument('source', help='каталог с файлами страниц')
+    parser.add_argument('target', help='каталог PackedStore')
+    parser.add_argument('--format', default='{}', help='шаблон имени файла, например "{}.html"')
+    args = parser.parse_args()
+
+    with PackedStore(args.target) as target:
+        migrate(DirectoryStore(args.source, args.format), target)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import itertools
+import multiprocessing
+
+
+def chunks(iterable, size):
+    """ Разбиение итератора на списки длиной не больше size """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parallel_map(fn, iterable, workers=None, ordered=True, chunk_size=None):
+    """ Применение fn к элементам iterable в пуле процессов
+
+    Элементы отправляются в пул порциями по chunk_size, поэтому в памяти
+    одновременно находится не больше одной порции входных данных и результатов.
+    При ordered=False результаты возвращаются по мере готовности.
+    Если workers <= 1, fn выполняется в текущем процессе.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers <= 1:
+        yield from map(fn, iterable)
+        return
+
+    chunk_size = chunk_size or workers * 64
+    task_chunksize = max(1, chunk_size // (workers * 4))
+    with multiprocessing.Pool(workers) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for chunk in chunks(iterable, chunk_size):
+            yield from imap(fn, chunk, task_chunksize)
@@ -0,0 +1,125 @@
+""" Потоковый конвейер скачивание -> парсинг -> загрузка в БД
+
+Стадии работают одновременно и связаны ограниченными очередями: если
+загрузка в БД не успевает, заполняется её очередь, парсеры ждут места,
+и скачивание приостанавливается. Общее время стремится ко времени самой
+медленной стадии, а не к сумме всех трёх.
+
+    async with Fetcher(...) as fetcher:
+        await pipeline.run(
+            ((str(i), url_format.format(i)) for i in ids),
+            lambda key, url: fetcher.fetch(url, key=key),
+            parse_seafarer_page,
+            load_batch,
+            archive=pages,
+        )
+
+Стадии:
+    fetch(key, url) - корутина, возвращает байты страницы или None;
+        скачанные страницы дописываются в archive в отдельном потоке, а уже
+        имеющиеся в нём читаются оттуда в том же потоке без запроса;
+    parse((key, data)) -> (key, obj, elapsed) - выполняется в пуле
+        процессов при parse_workers > 1 (0 - по числу ядер, как в
+        parallel_map), пустой obj удаляет страницу из archive;
+    load([(key, obj), ...]) - пачка объектов, выполняется в отдельном потоке БД;
+    on_archived(key, url) - вызывается для страниц, взятых из archive без запроса.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from tqdm import tqdm
+
+import metrics
+from page_store import AsyncWriter
+
+
+async def run(items, fetch, parse, load, archive=None, fetch_workers=20, parse_workers=1,
+              batch_size=500, queue_size=100, source='pipeline', on_archived=None):
+    """ Запуск конвейера по items - (key, url); возвращает число загруженных объектов """
+    loop = asyncio.get_running_loop()
+    items = iter(items)
+    parse_queue = asyncio.Queue(maxsize=queue_size)
+    load_queue = asyncio.Queue(maxsize=queue_size)
+    parse_workers = parse_workers or multiprocessing.cpu_count()
+    parse_executor = ProcessPoolExecutor(parse_workers) if parse_workers > 1 else ThreadPoolExecutor(1)
+    load_executor = ThreadPoolExecutor(1)
+    writer = AsyncWriter(archive) if archive is not None else None
+    progress = tqdm(desc=f'Pipeline {source}')
+    loaded = 0
+
+    async def fetcher():
+        for key, url in items:
+            if archive is not None and key in archive:
+                data = await writer.get(key)
+                if on_archived is not None:
+                    on_archived(key, url)
+            else:
+                data = await fetch(key, url)
+                if data is None:
+                    continue
+                if writer is not None:
+                    await writer.put(key, data)
+            await parse_queue.put((key, data))
+            metrics.gauge('queue_depth', parse_queue.qsize(), source=source, stage='parse')
+
+    async def parser():
+        while True:
+            page = await parse_queue.get()
+            if page is None:
+                return
+            key, obj, elapsed = await loop.run_in_executor(parse_executor, parse, page)
+            metrics.observe('parse_seconds', elapsed, source=source)
+            if not obj:
+                if writer is not None:
+                    await writer.delete(key)
+                continue
+            await load_queue.put((key, obj))
+            metrics.gauge('queue_depth', load_queue.qsize(), source=source, stage='load')
+
+    async def loader():
+        nonlocal loaded
+        batch = []
+        while True:
+            item = await load_queue.get()
+            if item is not None:
+                batch.append(item)
+            if batch and (item is None or len(batch) >= batch_size):
+                await loop.run_in_executor(load_executor, load, batch)
+                loaded += len(batch)
+                progress.update(len(batch))
+                batch = []
+            if item is None:
+                return
+
+    fetchers = [asyncio.create_task(fetcher()) for _ in range(fetch_workers)]
+    parsers = [asyncio.create_task(parser()) for _ in range(parse_workers)]
+    load_task = asyncio.create_task(loader())
+
+    async def finish():
+        """ Остановка стадий по очереди, когда закончились входные данные """
+        await asyncio.gather(*fetchers)
+        for _ in parsers:
+            await parse_queue.put(None)
+        await asyncio.gather(*parsers)
+        await load_queue.put(None)
+        await load_task
+
+    tasks = [*fetchers, *parsers, load_task]
+    finish_task = asyncio.create_task(finish())
+    try:
+        done, _ = await asyncio.wait([finish_task, *tasks], return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+        await finish_task
+    finally:
+        for task in [finish_task, *tasks]:
+            task.cancel()
+        await asyncio.gather(finish_task, *tasks, return_exceptions=True)
+        parse_executor.shutdown()
+        load_executor.shutdown()
+        if writer is not None:
+            writer.close()
+        progress.close()
+
+    return loaded
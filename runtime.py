@@ -0,0 +1,82 @@
+""" Ленивая инициализация общих ресурсов
+
+Модули скраперов при импорте не подключаются к БД, не инициализируют
+Sentry и не создают файлов: подключение к БД и хранилища создаются при
+первом обращении, а Sentry инициализирует точка входа (cli.py).
+
+    db = LazyDatabase(lambda: connect(env('DATABASE_URL')))
+    pages = Lazy(lambda: open_store(env.path('SHIP_DATA_DIR')))
+"""
+import os
+import threading
+
+import peewee
+
+
+class LazyDatabase(peewee.DatabaseProxy):
+    """ DatabaseProxy, который подключается к БД при первом обращении """
+    __slots__ = ('obj', '_callbacks', '_Model', 'factory')
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __getattr__(self, attr):
+        if self.obj is None:
+            self.initialize(self.factory())
+        return getattr(self.obj, attr)
+
+
+class Lazy:
+    """ Объект, создаваемый фабрикой при первом обращении к нему
+
+    Обращения к атрибутам передаются созданному объекту, поэтому у самого
+    Lazy нет публичных атрибутов.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory()
+        return self._obj
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self._resolve(), attr)
+
+    def __contains__(self, key):
+        return key in self._resolve()
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def __iter__(self):
+        return iter(self._resolve())
+
+
+_sentry_initialized = False
+
+
+def init_sentry(aiohttp=True):
+    """ Инициализация Sentry (с интеграцией aiohttp), один раз на процесс """
+    global _sentry_initialized
+    if _sentry_initialized:
+        return
+    import sentry_sdk
+
+    integrations = []
+    if aiohttp:
+        from sentry_sdk.integrations.aiohttp import AioHttpIntegration
+        integrations.append(AioHttpIntegration())
+
+    sentry_sdk.init(
+        os.environ.get('SENTRY_TOKEN'),
+        integrations=integrations
+    )
+    _sentry_initialized = True
@@ -1,25 +1,34 @@
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import json
 from console_progressbar import ProgressBar
-import sentry_sdk
-import os
+import sys
+import time
 
-sentry_sdk.init(
-    os.environ.get('SENTRY_TOKEN'),
-)
+import extract
+import metrics
 
 site = 'https://seafarersmatter.com/index.php/the-letter/?'
 
-def get_page(page_number):
-    users = []
-    url = f'{site}listpage={page_number}&instance=2'
-    
-    response = requests.get(url)
-    response.raise_for_status()
+CONCURRENCY = 8
+USERS_FILENAME = 'users.jsonl'
+EXPORT_FILENAME = 'users.json'
+
+session = requests.Session()
+
+def mount_adapter(concurrency):
+    """ Пул соединений сессии не меньше числа одновременных запросов """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-    page = response.content.decode('utf-8')
+def parse_page_soup(page):
+    """ Участники и номер последней страницы из HTML страницы списка """
+    users = []
     page = BeautifulSoup(page, 'html.parser')
 
     container = page.find('div', {'class': 'participants-database', 'id': 'participants-list-2'})
@@ -45,25 +54,75 @@ def get_page(page_number):
     
     return users, last_page
 
-def main():
-    all_users = []
+def parse_page(page):
+    """ То же, что parse_page_soup, но через lxml и только внутри #participants-list-2 """
+    root = extract.parse_document(page)
+    container = root.get_element_by_id('participants-list-2')
+    table = extract.find_first(container, 'table', 'list-container')
+
+    last_page = None
+    links = container.xpath('.//li[contains(concat(" ", normalize-space(@class), " "), " lastpage ")]//a')
+    if links:
+        last_page = int(links[0].get('data-page'))
+
+    users = []
+    for row in table.xpath('.//tbody//tr'):
+        first_name = ''
+        last_name = ''
+        for cell in extract.child_elements(row):
+            if extract.has_class(cell, 'first_name-field'):
+                first_name = extract.element_string(cell).strip()
+            if extract.has_class(cell, 'last_name-field'):
+                last_name = extract.element_string(cell).strip()
+        users.append({'first_name': first_name, 'last_name': last_name})
+
+    return users, last_page
+
+def get_page(page_number):
+    url = f'{site}listpage={page_number}&instance=2'
+    
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = session.get(url)
+        status = response.status_code
+        metrics.inc('fetch_bytes_total', len(response.content), source='seafarersmatter')
+    finally:
+        metrics.observe('fetch_seconds', time.perf_counter() - started, source='seafarersmatter', status=status)
+    response.raise_for_status()
+
+    with metrics.timer('parse_seconds', source='seafarersmatter'):
+        return parse_page(response.content.decode('utf-8'))
+
+def export_json(filename=USERS_FILENAME, export_filename=EXPORT_FILENAME):
+    """ Выгрузка users.jsonl в прежний формат users.json """
+    with open(filename, 'r', encoding='utf-8') as file:
+        users = [json.loads(line) for line in file if line.strip()]
+    with open(export_filename, 'w') as file:
+        json.dump(users, file, indent=4)
+
+def main(concurrency=CONCURRENCY, filename=USERS_FILENAME):
+    """ Обход всех страниц участников
+
+    Номер последней страницы берётся из первой страницы, остальные страницы
+    скачиваются параллельно в concurrency потоков. Участники дописываются
+    в filename (JSONL) по мере готовности страниц, в порядке страниц.
+    """
     pb = ProgressBar(total=100,prefix='Here', suffix='Now', decimals=3, length=50, fill='\u25A0', zfill='-')
     pb.print_progress_bar(0)
+    mount_adapter(concurrency)
 
-    i = 1
-    last_page = 1
+    users, last_page = get_page(1)
+    last_page = last_page or 1
 
-    while last_page:
-        users, last_page = get_page(i)
-        all_users.extend(users)
-        if last_page:
+    with open(filename, 'w', encoding='utf-8') as file, ThreadPoolExecutor(concurrency) as executor:
+        pages = itertools.chain([(users, last_page)], executor.map(get_page, range(2, last_page + 1)))
+        for i, (users, _) in enumerate(pages, 1):
+            for user in users:
+                file.write(json.dumps(user, ensure_ascii=False) + '\n')
+            file.flush()
             pb.print_progress_bar((i / last_page) * 100)
-        else:
-            pb.print_progress_bar(100)
-        i += 1
-
-    with open('users.json', 'w') as file:
-        json.dump(all_users, file, indent=4)
 
 if __name__ == "__main__":
-    main()
+    import cli
+    cli.main(['seafarersmatter', *(sys.argv[1:] or ['crawl'])])